@@ -1,16 +1,346 @@
-from auth import AuthError, requires_auth
-from flask import abort, Flask, jsonify, request
+import atexit
+import hashlib
+import os
+import time
+from auth import AuthError, init_auth, requires_auth
+from cache import create_backend, ResponseCache
+from flask import (
+    abort,
+    Flask,
+    g,
+    make_response,
+    request,
+    Response,
+    stream_with_context
+)
 from flask_cors import CORS
-from helpers import validate_schema
-from models import Actor, Movie, Performance, setup_db
-from sqlalchemy import func
+from functools import wraps
+from helpers import (
+    compress_response,
+    COMPRESSORS,
+    generate_ndjson,
+    get_expand_args,
+    get_fields_args,
+    get_filter_args,
+    get_json_provider,
+    get_page_args,
+    get_search_args,
+    get_sort_args,
+    jsonify,
+    order_by,
+    paginate,
+    validate_schema,
+    wants_stream
+)
+from metrics import (
+    Counter,
+    Histogram,
+    MultiProcessExporter,
+    render as render_metrics
+)
+from models import (
+    Actor,
+    db,
+    Movie,
+    Performance,
+    setup_db,
+    TableVersion
+)
+from profiling import init_profiling, timed
+from sqlalchemy import func, tuple_
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.orm import joinedload, load_only
 
+# Times a bulk insert is tried when concurrent writes make it conflict
+BULK_INSERT_ATTEMPTS = 3
+REQUESTS = Counter(
+    'agency_http_requests_total',
+    'HTTP requests by route, method and status',
+    ('route', 'method', 'status')
+)
+REQUEST_DURATION = Histogram(
+    'agency_http_request_duration_seconds',
+    'HTTP request latency by route and method',
+    ('route', 'method')
+)
 
-def create_app(test_config=None):
 
+def create_app(config=None):
+    '''Build the app from the environment, overridden by config
+
+    Settings are only read here, so importing this module needs no
+    environment and builds nothing.
+    '''
     app = Flask(__name__)
-    setup_db(app)
+    app.config.from_mapping(
+        DATABASE_URL=os.environ.get('DATABASE_URL'),
+        AUTH0_DOMAIN=os.environ.get('AUTH0_DOMAIN'),
+        API_AUDIENCE=os.environ.get('API_AUDIENCE'),
+        ALGORITHMS=os.environ.get('ALGORITHMS'),
+        JWKS_URL=os.environ.get('JWKS_URL'),
+        JWKS_TTL=int(os.environ.get('JWKS_TTL', 3600)),
+        JWKS_REFRESH_INTERVAL=int(os.environ.get('JWKS_REFRESH_INTERVAL', 30)),
+        JWKS_TIMEOUT=int(os.environ.get('JWKS_TIMEOUT', 5)),
+        TOKEN_CACHE_SIZE=int(os.environ.get('TOKEN_CACHE_SIZE', 4096)),
+        ROLES_CLAIM=os.environ.get('ROLES_CLAIM'),
+        DEFAULT_PAGE_SIZE=int(os.environ.get('DEFAULT_PAGE_SIZE', 100)),
+        MAX_PAGE_SIZE=int(os.environ.get('MAX_PAGE_SIZE', 1000)),
+        STREAM_BATCH_SIZE=int(os.environ.get('STREAM_BATCH_SIZE', 1000)),
+        MAX_BULK_SIZE=int(os.environ.get('MAX_BULK_SIZE', 1000)),
+        DB_POOL_SIZE=int(os.environ.get('DB_POOL_SIZE', 5)),
+        DB_MAX_OVERFLOW=int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+        DB_POOL_TIMEOUT=float(os.environ.get('DB_POOL_TIMEOUT', 30)),
+        DB_POOL_RECYCLE=int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+        DB_POOL_PRE_PING=os.environ.get(
+            'DB_POOL_PRE_PING', 'true').lower() not in ('false', '0'),
+        DB_STATEMENT_TIMEOUT=int(os.environ.get('DB_STATEMENT_TIMEOUT', 0)),
+        PROFILE=os.environ.get('PROFILE', 'false').lower() in ('true', '1'),
+        PROFILE_SAMPLE_RATE=float(os.environ.get('PROFILE_SAMPLE_RATE', 0)),
+        PROFILE_DIR=os.environ.get('PROFILE_DIR', 'profiles'),
+        SEARCH_LIMIT=int(os.environ.get('SEARCH_LIMIT', 10)),
+        MAX_SEARCH_LIMIT=int(os.environ.get('MAX_SEARCH_LIMIT', 50)),
+        CACHE_TYPE=os.environ.get('CACHE_TYPE', 'null'),
+        CACHE_SIZE=int(os.environ.get('CACHE_SIZE', 1024)),
+        CACHE_TTL=int(os.environ.get('CACHE_TTL', 300)),
+        CACHE_REDIS_URL=os.environ.get('CACHE_REDIS_URL'),
+        JSON_PROVIDER=os.environ.get('JSON_PROVIDER', 'orjson'),
+        COMPRESS_ENCODINGS=os.environ.get(
+            'COMPRESS_ENCODINGS', 'br,gzip').split(','),
+        COMPRESS_MIN_SIZE=int(os.environ.get('COMPRESS_MIN_SIZE', 1024)),
+        METRICS_DIR=os.environ.get('METRICS_DIR'),
+        METRICS_FLUSH_INTERVAL=float(
+            os.environ.get('METRICS_FLUSH_INTERVAL', 5))
+    )
+    if config is not None:
+        app.config.update(config)
+    setup_db(app, app.config['DATABASE_URL'])
+    init_auth(app)
     CORS(app)
+    exporter = None
+    if app.config['METRICS_DIR']:
+        exporter = MultiProcessExporter(
+            app.config['METRICS_DIR'], app.config['METRICS_FLUSH_INTERVAL'])
+        atexit.register(exporter.flush)
+    app.extensions['metrics_exporter'] = exporter
+
+    @app.before_request
+    def start_request_timer():
+        '''Start timing the request for the latency histogram'''
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        '''Count the request and observe its latency by route'''
+        start = g.pop('request_start', None)
+        if start is None:
+            return response
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        REQUEST_DURATION.observe(
+            time.perf_counter() - start, route=route, method=request.method)
+        REQUESTS.inc(
+            route=route, method=request.method, status=response.status_code)
+        if exporter is not None:
+            exporter.start()
+        return response
+
+    init_profiling(app)
+
+    def get_table_versions(tables):
+        '''Return the version of each of tables, read once per request'''
+        versions = g.setdefault('table_versions', {})
+        missing = [table for table in tables if table not in versions]
+        if missing:
+            versions.update(zip(missing, TableVersion.get_versions(missing)))
+        return [versions[table] for table in tables]
+
+    @app.teardown_request
+    def forget_table_versions(error=None):
+        '''Read the versions afresh on the next request, which may share
+        this app context'''
+        g.pop('table_versions', None)
+
+    cache = ResponseCache(
+        create_backend(app.config), get_table_versions,
+        app.config['CACHE_TTL'])
+    app.extensions['response_cache'] = cache
+    app.extensions['json_dumps'] = get_json_provider(
+        app.config['JSON_PROVIDER'], app.logger)
+
+    for encoding in app.config['COMPRESS_ENCODINGS']:
+        if encoding and encoding not in COMPRESSORS:
+            app.logger.warning(
+                'Cannot compress with %s (br needs brotli), skipping it',
+                encoding)
+
+    @app.after_request
+    def compress(response):
+        '''Compress large responses the client accepts compressed'''
+        with timed('compress'):
+            return compress_response(
+                response,
+                request.accept_encodings,
+                app.config['COMPRESS_ENCODINGS'],
+                app.config['COMPRESS_MIN_SIZE']
+            )
+
+    # HELPERS
+
+    def get_page(query, columns, descending=False):
+        '''Return the requested keyset page of query and the next cursor'''
+        page = get_page_args(
+            request.args,
+            columns,
+            app.config['DEFAULT_PAGE_SIZE'],
+            app.config['MAX_PAGE_SIZE']
+        )
+        if page is None:
+            abort(400)
+        return paginate(query, columns, *page, descending)
+
+    def get_sort(model):
+        '''Return the columns and direction of the requested sort of model,
+        ending with the id so that the order is unique'''
+        sort = get_sort_args(request.args, model.SORTS)
+        if sort is None:
+            abort(400)
+        name, descending = sort
+        if name == 'id':
+            return (model.id,), descending
+        return (getattr(model, name), model.id), descending
+
+    def get_filters(model):
+        '''Return SQL criteria for the requested filters of model'''
+        criteria = get_filter_args(request.args, model.FILTERS)
+        if criteria is None:
+            abort(400)
+        return criteria
+
+    def get_fields(model, columns=()):
+        '''Return the fields of model named by the fields query string
+        argument and a query loading only their columns and columns'''
+        fields = get_fields_args(request.args, model.FIELDS)
+        if fields is None:
+            abort(400)
+        loaded = [getattr(model, field) for field in fields]
+        loaded += [column for column in columns if column.key not in fields]
+        return fields, model.query.options(load_only(*loaded))
+
+    def stream(query, columns, formatter=lambda row: row.format(),
+               descending=False):
+        '''Return every row of query ordered by columns as streamed NDJSON'''
+        batch_size = app.config['STREAM_BATCH_SIZE']
+        rows = query.order_by(*order_by(columns, descending)).yield_per(
+            batch_size)
+        items = (formatter(row) for row in rows)
+        return Response(
+            stream_with_context(generate_ndjson(
+                items, batch_size, app.extensions['json_dumps'])),
+            mimetype='application/x-ndjson'
+        )
+
+    def conditional(*tables):
+        '''Decorator answering a GET request whose If-None-Match holds the
+        current ETag with 304 Not Modified, without calling the view
+
+        The ETag hashes the path and query string with the version of
+        each table the response is read from, so checking it costs one
+        small query, shared with the response cache. It is weak, as the
+        body may be sent compressed. With the cache off, a request without
+        If-None-Match skips that query and gets no ETag.
+        '''
+        def conditional_decorator(f):
+            @wraps(f)
+            def wrapper(*args, **kwargs):
+                if wants_stream(request) or not (
+                        cache.enabled or request.if_none_match):
+                    return f(*args, **kwargs)
+                versions = get_table_versions(tables)
+                etag = hashlib.sha1(
+                    repr((request.full_path, versions)).encode()
+                ).hexdigest()
+                if request.if_none_match.contains_weak(etag):
+                    response = Response(status=304)
+                    del response.headers['Content-Type']
+                else:
+                    response = make_response(f(*args, **kwargs))
+                    if response.status_code != 200:
+                        return response
+                response.set_etag(etag, weak=True)
+                return response
+            return wrapper
+        return conditional_decorator
+
+    def get_bulk_body(type):
+        '''Return the items of a bulk request body validated and coerced by
+        the schema for type, with None for each item that is not valid'''
+        body = request.get_json()
+        if not isinstance(body, list):
+            abort(422)
+        if not 1 <= len(body) <= app.config['MAX_BULK_SIZE']:
+            abort(422)
+        return [validate_schema(item, type=type) for item in body]
+
+    def discard_conflicts(objects, key, existing):
+        '''Replace objects whose key already exists, or repeats an earlier
+        object in the batch, with None'''
+        seen = set(existing)
+        for i, obj in enumerate(objects):
+            if obj is None:
+                continue
+            if key(obj) in seen:
+                objects[i] = None
+            seen.add(key(obj))
+
+    def bulk_create(name, objects, discard=None):
+        '''Insert objects in one statement and return per item results
+
+        None marks an item that is not valid. Unless the atomic query
+        string argument is false, one such item rejects the whole batch.
+        discard(objects) replaces the objects that conflict with stored
+        rows with None; if a concurrent write makes the insert conflict
+        anyway, it is run again and the insert retried.
+        '''
+        atomic = request.args.get('atomic', 'true').lower() not in (
+            'false', '0')
+        for _ in range(BULK_INSERT_ATTEMPTS):
+            if discard is not None:
+                discard(objects)
+            created = [obj for obj in objects if obj is not None]
+            if atomic and len(created) < len(objects):
+                created = []
+            if not created:
+                break
+            try:
+                with db.session.begin_nested():
+                    db.session.add_all(created)
+            except IntegrityError:
+                created = []
+                continue
+            break
+        results = []
+        for obj in objects:
+            if obj is None:
+                results.append({
+                    'success': False,
+                    'error': 422,
+                    'message': 'Unprocessable Entity'
+                })
+            elif created:
+                results.append({'success': True, name: obj.format()})
+            else:
+                results.append({'success': False})
+        db.session.commit()
+        if not created:
+            return jsonify({
+                'success': False,
+                'error': 422,
+                'message': 'Unprocessable Entity',
+                'results': results
+            }), 422
+        return jsonify({
+            'success': len(created) == len(objects),
+            'results': results
+        })
 
     # ROUTES
 
@@ -19,32 +349,74 @@ def create_app(test_config=None):
         '''Handle GET requests'''
         return 'running'
 
+    @app.route('/metrics')
+    def get_metrics():
+        '''Handle GET requests for metrics'''
+        if exporter is not None:
+            return Response(exporter.render(), mimetype='text/plain')
+        return Response(render_metrics(), mimetype='text/plain')
+
     @app.route('/actors')
     @requires_auth('get:actors')
+    @conditional('actors')
+    @cache.cached('actors')
     def get_actors():
         '''Handle GET requests for actors'''
-        actors = Actor.query.all()
+        columns, descending = get_sort(Actor)
+        fields, query = get_fields(Actor, columns)
+        query = query.filter(*get_filters(Actor))
+        if wants_stream(request):
+            return stream(
+                query,
+                columns,
+                lambda actor: actor.format(fields),
+                descending
+            )
+        actors, next_cursor = get_page(query, columns, descending)
         return jsonify({
-            'actors': [actor.format() for actor in actors]
+            'actors': [actor.format(fields) for actor in actors],
+            'next_cursor': next_cursor
         })
 
     @app.route('/actors/<int:actor_id>')
     @requires_auth('get:actors')
+    @conditional('actors')
+    @cache.cached('actors')
     def get_actors_by_id(actor_id):
         '''Handle GET requests for actors by id'''
-        actor = Actor.query.get(actor_id)
+        fields, query = get_fields(Actor)
+        actor = query.get(actor_id)
         if actor is None:
             abort(404)
         return jsonify({
-            'actor': actor.format()
+            'actor': actor.format(fields)
+        })
+
+    @app.route('/actors/<int:actor_id>/movies')
+    @requires_auth(['get:movies', 'get:performances'])
+    @conditional('actors', 'movies', 'performances')
+    @cache.cached('actors', 'movies', 'performances')
+    def get_actors_movies(actor_id):
+        '''Handle GET requests for movies by actor id'''
+        fields, query = get_fields(Movie)
+        movies, next_cursor = get_page(
+            query.join(Movie.actors).filter(
+                Performance.actor_id == actor_id),
+            (Movie.id,)
+        )
+        if not movies and Actor.query.get(actor_id) is None:
+            abort(404)
+        return jsonify({
+            'movies': [movie.format(fields) for movie in movies],
+            'next_cursor': next_cursor
         })
 
     @app.route('/actors', methods=['POST'])
     @requires_auth('post:actors')
     def post_actor():
         '''Handle POST requests for actors'''
-        body = request.get_json()
-        if not validate_schema(body, type='post-actor'):
+        body = validate_schema(request.get_json(), type='post-actor')
+        if body is None:
             abort(422)
         actor = Actor(
             name=body['name'],
@@ -56,19 +428,26 @@ def create_app(test_config=None):
             'actor': actor.format()
         })
 
+    @app.route('/actors/bulk', methods=['POST'])
+    @requires_auth('post:actors')
+    def post_actors_bulk():
+        '''Handle bulk POST requests for actors'''
+        actors = [
+            None if item is None else Actor(**item)
+            for item in get_bulk_body(type='post-actor')
+        ]
+        return bulk_create('actor', actors)
+
     @app.route('/actors/<int:actor_id>', methods=['PATCH'])
     @requires_auth('patch:actors')
     def patch_actor(actor_id):
         '''Handle PATCH requests for actors by id'''
-        body = request.get_json()
-        if not validate_schema(body, type='patch-actor'):
+        body = validate_schema(request.get_json(), type='patch-actor')
+        if body is None:
             abort(422)
-        actor = Actor.query.get(actor_id)
+        actor = Actor.update_by_id(actor_id, body)
         if actor is None:
             abort(404)
-        for key in body.keys():
-            setattr(actor, key, body[key])
-        actor.update()
         return jsonify({
             'actor': actor.format()
         })
@@ -77,49 +456,76 @@ def create_app(test_config=None):
     @requires_auth('delete:actors')
     def delete_actor(actor_id):
         '''Handle DELETE requests for actors by id'''
-        actor = Actor.query.get(actor_id)
-        if actor is None:
+        if not Actor.delete_by_id(actor_id):
             abort(404)
-        actor.delete()
         return jsonify({
             'deleted': actor_id
         })
 
     @app.route('/movies')
     @requires_auth('get:movies')
+    @conditional('movies')
+    @cache.cached('movies')
     def get_movies():
         '''Handle GET requests for movies'''
-        movies = Movie.query.all()
+        columns, descending = get_sort(Movie)
+        fields, query = get_fields(Movie, columns)
+        query = query.filter(*get_filters(Movie))
+        if wants_stream(request):
+            return stream(
+                query,
+                columns,
+                lambda movie: movie.format(fields),
+                descending
+            )
+        movies, next_cursor = get_page(query, columns, descending)
         return jsonify({
-            'movies': [movie.format() for movie in movies]
+            'movies': [movie.format(fields) for movie in movies],
+            'next_cursor': next_cursor
         })
 
     @app.route('/movies/<int:movie_id>')
     @requires_auth('get:movies')
+    @conditional('movies')
+    @cache.cached('movies')
     def get_movies_by_id(movie_id):
         '''Handle GET requests for movies by id'''
-        movie = Movie.query.get(movie_id)
+        fields, query = get_fields(Movie)
+        movie = query.get(movie_id)
         if movie is None:
             abort(404)
         return jsonify({
-            'movie': movie.format()
+            'movie': movie.format(fields)
+        })
+
+    @app.route('/movies/<int:movie_id>/actors')
+    @requires_auth(['get:actors', 'get:performances'])
+    @conditional('actors', 'movies', 'performances')
+    @cache.cached('actors', 'movies', 'performances')
+    def get_movies_actors(movie_id):
+        '''Handle GET requests for actors by movie id'''
+        fields, query = get_fields(Actor)
+        actors, next_cursor = get_page(
+            query.join(Actor.movies).filter(
+                Performance.movie_id == movie_id),
+            (Actor.id,)
+        )
+        if not actors and Movie.query.get(movie_id) is None:
+            abort(404)
+        return jsonify({
+            'actors': [actor.format(fields) for actor in actors],
+            'next_cursor': next_cursor
         })
 
     @app.route('/movies', methods=['POST'])
     @requires_auth('post:movies')
     def post_movie():
         '''Handle POST requests for movies'''
-        body = request.get_json()
-        if not validate_schema(body, type='post-movie'):
-            abort(422)
-        title = body['title']
-        movie = Movie.query.filter(
-            func.lower(Movie.title) == title.lower()
-        ).first()
-        if movie is not None:
+        body = validate_schema(request.get_json(), type='post-movie')
+        if body is None:
             abort(422)
         movie = Movie(
-            title=title,
+            title=body['title'],
             release_date=body['release_date']
         )
         movie.insert()
@@ -127,27 +533,37 @@ def create_app(test_config=None):
             'movie': movie.format()
         })
 
+    @app.route('/movies/bulk', methods=['POST'])
+    @requires_auth('post:movies')
+    def post_movies_bulk():
+        '''Handle bulk POST requests for movies'''
+        movies = [
+            None if item is None else Movie(**item)
+            for item in get_bulk_body(type='post-movie')
+        ]
+
+        def discard_existing(movies):
+            titles = {movie.title.lower() for movie in movies if movie}
+            existing = db.session.query(func.lower(Movie.title)).filter(
+                func.lower(Movie.title).in_(titles))
+            discard_conflicts(
+                movies,
+                lambda movie: movie.title.lower(),
+                (title for title, in existing)
+            )
+
+        return bulk_create('movie', movies, discard_existing)
+
     @app.route('/movies/<int:movie_id>', methods=['PATCH'])
     @requires_auth('patch:movies')
     def patch_movie(movie_id):
         '''Handle PATCH requests for movies by id'''
-        body = request.get_json()
-        if not validate_schema(body, type='patch-movie'):
-            abort(422)
-        title = body.get('title')
-        if title is not None:
-            movie = Movie.query.filter(
-                Movie.id != movie_id,
-                func.lower(Movie.title) == title.lower()
-            ).first()
-        if movie is not None:
+        body = validate_schema(request.get_json(), type='patch-movie')
+        if body is None:
             abort(422)
-        movie = Movie.query.get(movie_id)
+        movie = Movie.update_by_id(movie_id, body)
         if movie is None:
             abort(404)
-        for key in body.keys():
-            setattr(movie, key, body[key])
-        movie.update()
         return jsonify({
             'movie': movie.format()
         })
@@ -156,66 +572,130 @@ def create_app(test_config=None):
     @requires_auth('delete:movies')
     def delete_movie(movie_id):
         '''Handle DELETE requests for movies by id'''
-        movie = Movie.query.get(movie_id)
-        if movie is None:
+        if not Movie.delete_by_id(movie_id):
             abort(404)
-        movie.delete()
         return jsonify({
             'deleted': movie_id
         })
 
     @app.route('/performances')
     @requires_auth('get:performances')
+    @conditional('actors', 'movies', 'performances')
+    @cache.cached('actors', 'movies', 'performances')
     def get_performances():
         '''Handle GET requests for performances'''
-        performances = Performance.query.all()
+        expand = get_expand_args(request.args, ('actor', 'movie'))
+        if expand is None:
+            abort(400)
+        fields, query = get_fields(Performance)
+        query = query.options(*(
+            joinedload(getattr(Performance, name), innerjoin=True)
+            for name in expand
+        ))
+        if wants_stream(request):
+            return stream(
+                query,
+                (Performance.id,),
+                lambda performance: performance.format(expand, fields)
+            )
+        performances, next_cursor = get_page(query, (Performance.id,))
         return jsonify({
-            'performances':
-                [performance.format() for performance in performances]
+            'performances': [
+                performance.format(expand, fields)
+                for performance in performances
+            ],
+            'next_cursor': next_cursor
         })
 
     @app.route('/performances', methods=['POST'])
     @requires_auth('post:performances')
     def post_performance():
         '''Handle POST requests for performances'''
-        body = request.get_json()
-        if not validate_schema(body, type='post-performance'):
-            abort(422)
-        actor_id = body['actor_id']
-        movie_id = body['movie_id']
-        actor = Actor.query.filter(Actor.id == actor_id).first()
-        if actor is None:
-            abort(422)
-        movie = Movie.query.filter(Movie.id == movie_id).first()
-        if movie is None:
-            abort(422)
-        performance = Performance.query.filter(
-            Performance.actor_id == actor_id,
-            Performance.movie_id == movie_id
-        ).first()
-        if performance is not None:
+        body = validate_schema(request.get_json(), type='post-performance')
+        if body is None:
             abort(422)
         performance = Performance(
-            actor_id=actor_id,
-            movie_id=movie_id
+            actor_id=body['actor_id'],
+            movie_id=body['movie_id']
         )
-        performance.insert()
+        db.session.add(performance)
+        db.session.flush()
+        performance_format = performance.format()
+        db.session.commit()
         return jsonify({
-            'performance': performance.format()
+            'performance': performance_format
         })
 
+    @app.route('/performances/bulk', methods=['POST'])
+    @requires_auth('post:performances')
+    def post_performances_bulk():
+        '''Handle bulk POST requests for performances'''
+        performances = [
+            None if item is None else Performance(**item)
+            for item in get_bulk_body(type='post-performance')
+        ]
+
+        def discard_existing(performances):
+            valid = [performance for performance in performances
+                     if performance]
+            actor_ids = {id for id, in db.session.query(Actor.id).filter(
+                Actor.id.in_({p.actor_id for p in valid}))}
+            movie_ids = {id for id, in db.session.query(Movie.id).filter(
+                Movie.id.in_({p.movie_id for p in valid}))}
+            for i, performance in enumerate(performances):
+                if performance is None:
+                    continue
+                if performance.actor_id not in actor_ids:
+                    performances[i] = None
+                elif performance.movie_id not in movie_ids:
+                    performances[i] = None
+            pair = tuple_(Performance.actor_id, Performance.movie_id)
+            existing = db.session.query(
+                Performance.actor_id, Performance.movie_id
+            ).filter(pair.in_({(p.actor_id, p.movie_id) for p in valid}))
+            discard_conflicts(
+                performances,
+                lambda performance: (
+                    performance.actor_id, performance.movie_id),
+                (tuple(row) for row in existing)
+            )
+
+        return bulk_create(
+            'performance', performances, discard_existing)
+
     @app.route('/performances/<int:performance_id>', methods=['DELETE'])
     @requires_auth('delete:performances')
     def delete_performance(performance_id):
         '''Handle DELETE requests for performances by id'''
-        performance = Performance.query.get(performance_id)
-        if performance is None:
+        if not Performance.delete_by_id(performance_id):
             abort(404)
-        performance.delete()
         return jsonify({
             'deleted': performance_id
         })
 
+    @app.route('/search')
+    @requires_auth(['get:actors', 'get:movies'])
+    @conditional('actors', 'movies')
+    @cache.cached('actors', 'movies')
+    def search():
+        '''Handle GET requests searching actor names and movie titles'''
+        page = get_search_args(
+            request.args,
+            app.config['SEARCH_LIMIT'],
+            app.config['MAX_SEARCH_LIMIT']
+        )
+        if page is None:
+            abort(400)
+        q, limit = page
+        return jsonify({
+            'actors': [
+                actor.format() for actor in Actor.search(Actor.name, q, limit)
+            ],
+            'movies': [
+                movie.format() for movie in Movie.search(Movie.title, q, limit)
+            ]
+        })
+
     # ERROR HANDLERS
 
     @app.errorhandler(400)
@@ -254,6 +734,12 @@ def create_app(test_config=None):
             'message': 'Internal Server Error'
         }), 500
 
+    @app.errorhandler(IntegrityError)
+    def integrity_error(error):
+        '''Handle database constraint violations'''
+        db.session.rollback()
+        return unprocessable_entity(error)
+
     @app.errorhandler(AuthError)
     def auth_error(error):
         '''Handle Auth errors'''
@@ -265,7 +751,36 @@ def create_app(test_config=None):
 
     return app
 
-APP = create_app()
+
+def warm_up(app, connections=0):
+    '''Fetch the signing keys and connect to the database ahead of the
+    first request
+
+    connections database connections are left open in the pool. With
+    none, the engine connects once and is then disposed, as the gunicorn
+    master does before forking so that workers never share a socket.
+
+    Warming up is best effort: when Auth0 or the database is unreachable
+    a warning is logged and the first requests retry on demand.
+    '''
+    keys = app.extensions['auth'].jwks.warm()
+    if not keys:
+        app.logger.warning('Warm up fetched no signing keys')
+    with app.app_context():
+        engine = db.engine
+        opened = []
+        try:
+            for _ in range(max(connections, 1)):
+                opened.append(engine.connect())
+        except (OperationalError, OSError) as e:
+            app.logger.warning('Warm up could not connect: %s', e)
+        finally:
+            for connection in opened:
+                connection.close()
+        if not connections:
+            engine.dispose()
+    return keys
+
 
 if __name__ == '__main__':
-    APP.run()
+    create_app().run()
@@ -1,13 +1,44 @@
+import hashlib
 import json
-import os
-from flask import request, _request_ctx_stack
+import threading
+import time
+from collections import OrderedDict
+from flask import current_app, request, _request_ctx_stack
 from functools import wraps
 from jose import jwt
+from metrics import Counter
+from profiling import timed
 from urllib.request import urlopen
 
-AUTH0_DOMAIN = os.environ.get('AUTH0_DOMAIN')
-ALGORITHMS = os.environ.get('ALGORITHMS')
-API_AUDIENCE = os.environ.get('API_AUDIENCE')
+CASTING_ASSISTANT = frozenset([
+    'get:actors',
+    'get:movies',
+    'get:performances'
+])
+CASTING_DIRECTOR = CASTING_ASSISTANT | frozenset([
+    'post:actors',
+    'patch:actors',
+    'delete:actors',
+    'post:performances',
+    'delete:performances'
+])
+EXECUTIVE_PRODUCER = CASTING_DIRECTOR | frozenset([
+    'post:movies',
+    'patch:movies',
+    'delete:movies'
+])
+ROLE_PERMISSIONS = {
+    'casting-assistant': CASTING_ASSISTANT,
+    'casting-director': CASTING_DIRECTOR,
+    'executive-producer': EXECUTIVE_PRODUCER
+}
+
+
+AUTH_FAILURES = Counter(
+    'agency_auth_failures_total',
+    'Requests rejected by authorization, by AuthError code',
+    ('code',)
+)
 
 
 class AuthError(Exception):
@@ -17,6 +48,165 @@ class AuthError(Exception):
         self.status_code = status_code
 
 
+class JWKSCache:
+    '''Cache the JSON Web Key Set for the life of the process
+
+    Keys are refetched once the TTL has passed, or early when a token
+    presents an unknown kid (at most once per refresh interval).
+    Concurrent refreshes collapse into a single fetch. Past the TTL, other
+    lookups keep using the cached keys instead of waiting for that fetch,
+    and the last good key set keeps being served while the identity
+    provider is unreachable.
+    '''
+    def __init__(self, url, ttl=3600, refresh_interval=30, timeout=5):
+        self.url = url
+        self.ttl = ttl
+        self.refresh_interval = refresh_interval
+        self.timeout = timeout
+        self.keys = {}
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.failures = 0
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._expires_at = 0
+        self._attempted_at = float('-inf')
+
+    def fetch(self):
+        '''Fetch the key set from the identity provider, keyed by kid'''
+        with urlopen(self.url, timeout=self.timeout) as response:
+            jwks = json.loads(response.read())
+        return {key['kid']: key for key in jwks['keys'] if 'kid' in key}
+
+    def refresh(self, generation, blocking=True):
+        '''Refresh the key set unless another thread already has or,
+        unless blocking, is doing so'''
+        if not self._lock.acquire(blocking):
+            return
+        try:
+            if self._generation != generation:
+                return
+            self._attempted_at = time.monotonic()
+            try:
+                with timed('jwks'):
+                    keys = self.fetch()
+            except Exception:
+                self.failures += 1
+                self._expires_at = self._attempted_at + self.refresh_interval
+            else:
+                self.refreshes += 1
+                self.keys = keys
+                self._expires_at = self._attempted_at + self.ttl
+            finally:
+                self._generation += 1
+        finally:
+            self._lock.release()
+
+    def get_key(self, kid):
+        '''Return the JWK for kid, or None if the key set lacks it'''
+        generation = self._generation
+        now = time.monotonic()
+        if now >= self._expires_at:
+            # Stale keys are served while another thread fetches new ones
+            self.refresh(generation, blocking=not self.keys)
+        key = self.keys.get(kid)
+        if key is not None:
+            self.hits += 1
+            return key
+        self.misses += 1
+        if now >= self._attempted_at + self.refresh_interval:
+            self.refresh(generation)
+            key = self.keys.get(kid)
+        if key is None and not self.keys:
+            raise AuthError({
+                'code': 'jwks_unavailable',
+                'description': 'Unable to fetch signing keys.'
+            }, 503)
+        return key
+
+    def warm(self):
+        '''Fetch the key set now unless it is still fresh, and return the
+        number of cached keys'''
+        if time.monotonic() >= self._expires_at:
+            self.refresh(self._generation)
+        return len(self.keys)
+
+    def clear(self):
+        '''Drop cached keys so the next lookup fetches afresh'''
+        with self._lock:
+            self.keys = {}
+            self._generation += 1
+            self._expires_at = 0
+            self._attempted_at = float('-inf')
+
+    def stats(self):
+        '''Return hit, miss, refresh and failure counters'''
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'refreshes': self.refreshes,
+            'failures': self.failures,
+            'keys': len(self.keys)
+        }
+
+
+class TokenCache:
+    '''Bounded LRU cache of verified token payloads
+
+    Entries are keyed by a SHA-256 digest of the token and hold the payload
+    with its granted permissions. They are dropped once the token's exp
+    claim has passed, so a repeat bearer token skips signature verification
+    until it expires.
+    '''
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, token):
+        '''Return the cached (payload, permissions) for token, or None'''
+        key = hashlib.sha256(token.encode()).digest()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.time() >= entry[1]:
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, token, payload, permissions):
+        '''Cache a verified payload and its permissions until exp'''
+        exp = payload.get('exp')
+        if not self.maxsize or not isinstance(exp, (int, float)):
+            return
+        key = hashlib.sha256(token.encode()).digest()
+        with self._lock:
+            self._entries[key] = ((payload, permissions), exp)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        '''Drop all cached payloads'''
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        '''Return hit and miss counters'''
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._entries)
+        }
+
+
 def get_token_auth_header():
     """Obtains the Access Token from the Authorization Header"""
     auth = request.headers.get('Authorization', None)
@@ -48,13 +238,39 @@ def get_token_auth_header():
     return token
 
 
-def check_permissions(permission, payload):
-    if 'permissions' not in payload:
+def get_permissions(payload, roles_claim=None):
+    '''Return the permissions granted by a payload as a frozenset
+
+    When roles_claim is set, roles listed in that claim are expanded
+    locally so tokens need not carry every permission.
+    '''
+    permissions = payload.get('permissions')
+    roles = payload.get(roles_claim) if roles_claim else None
+    if permissions is None and roles is None:
         raise AuthError({
             'code': 'invalid_claims',
             'description': 'Permissions not included in JWT.'
         }, 400)
-    if permission not in payload['permissions']:
+    granted = frozenset(permissions or ())
+    for role in roles or ():
+        granted |= ROLE_PERMISSIONS.get(role, frozenset())
+    return granted
+
+
+def permission_set(permission):
+    '''Return a permission name or collection of names as a frozenset'''
+    if isinstance(permission, str):
+        return frozenset([permission])
+    return frozenset(permission)
+
+
+def check_granted(required, granted, any_of=False):
+    '''Check granted covers all (or, with any_of, one) of required'''
+    if any_of:
+        allowed = not required or not required.isdisjoint(granted)
+    else:
+        allowed = required <= granted
+    if not allowed:
         raise AuthError({
             'code': 'unauthorized',
             'description': 'Permission not found.'
@@ -62,24 +278,41 @@ def check_permissions(permission, payload):
     return True
 
 
-def verify_decode_jwt(token):
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
-    try:
-        unverified_header = jwt.get_unverified_header(token)
-    except jwt.JWTError:
-        raise AuthError({
-            'code': 'invalid_header',
-            'description': 'Unable to decode token headers.'
-        }, 400)
-    rsa_key = {}
-    if 'kid' not in unverified_header:
-        raise AuthError({
-            'code': 'invalid_header',
-            'description': 'Authorization malformed.'
-        }, 401)
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
+def check_permissions(permission, payload, any_of=False):
+    return check_granted(
+        permission_set(permission), get_permissions(payload), any_of)
+
+
+class TokenVerifier:
+    '''Verify access tokens issued by an Auth0 tenant for an API
+
+    Holds the settings, signing keys and verified tokens of one app.
+    '''
+    def __init__(self, domain, audience, algorithms, jwks, tokens=None,
+                 roles_claim=None):
+        self.domain = domain
+        self.audience = audience
+        self.algorithms = algorithms
+        self.jwks = jwks
+        self.tokens = TokenCache() if tokens is None else tokens
+        self.roles_claim = roles_claim
+
+    def verify_decode_jwt(self, token):
+        try:
+            unverified_header = jwt.get_unverified_header(token)
+        except jwt.JWTError:
+            raise AuthError({
+                'code': 'invalid_header',
+                'description': 'Unable to decode token headers.'
+            }, 400)
+        rsa_key = {}
+        if 'kid' not in unverified_header:
+            raise AuthError({
+                'code': 'invalid_header',
+                'description': 'Authorization malformed.'
+            }, 401)
+        key = self.jwks.get_key(unverified_header['kid'])
+        if key is not None:
             rsa_key = {
                 'kty': key['kty'],
                 'kid': key['kid'],
@@ -87,45 +320,91 @@ def verify_decode_jwt(token):
                 'n': key['n'],
                 'e': key['e']
             }
-    if rsa_key:
-        try:
-            payload = jwt.decode(
-                token,
-                rsa_key,
-                algorithms=ALGORITHMS,
-                audience=API_AUDIENCE,
-                issuer='https://' + AUTH0_DOMAIN + '/'
-            )
+        if rsa_key:
+            try:
+                payload = jwt.decode(
+                    token,
+                    rsa_key,
+                    algorithms=self.algorithms,
+                    audience=self.audience,
+                    issuer='https://' + self.domain + '/'
+                )
+            except jwt.ExpiredSignatureError:
+                raise AuthError({
+                    'code': 'token_expired',
+                    'description': 'Token expired.'
+                }, 401)
+            except jwt.JWTClaimsError:
+                raise AuthError({
+                    'code': 'invalid_claims',
+                    'description': 'Incorrect claims. Please, check the '
+                                   'audience and issuer.'
+                }, 401)
+            except Exception:
+                raise AuthError({
+                    'code': 'invalid_header',
+                    'description': 'Unable to parse authentication token.'
+                }, 400)
             return payload
-        except jwt.ExpiredSignatureError:
-            raise AuthError({
-                'code': 'token_expired',
-                'description': 'Token expired.'
-            }, 401)
-        except jwt.JWTClaimsError:
-            raise AuthError({
-                'code': 'invalid_claims',
-                'description':
-                    'Incorrect claims. Please, check the audience and issuer.'
-            }, 401)
-        except Exception:
-            raise AuthError({
-                'code': 'invalid_header',
-                'description': 'Unable to parse authentication token.'
-            }, 400)
-    raise AuthError({
-        'code': 'invalid_header',
-        'description': 'Unable to find the appropriate key.'
-    }, 400)
+        raise AuthError({
+            'code': 'invalid_header',
+            'description': 'Unable to find the appropriate key.'
+        }, 400)
+
+    def authenticate(self, token):
+        '''Return the verified payload and granted permissions of a token'''
+        cached = self.tokens.get(token)
+        if cached is not None:
+            return cached
+        payload = self.verify_decode_jwt(token)
+        permissions = get_permissions(payload, self.roles_claim)
+        self.tokens.set(token, payload, permissions)
+        return payload, permissions
+
+
+def init_auth(app):
+    '''Verify tokens for app as set by its AUTH0_DOMAIN, API_AUDIENCE,
+    ALGORITHMS, JWKS_* and TOKEN_CACHE_SIZE config'''
+    config = app.config
+    jwks_url = config.get('JWKS_URL') or \
+        f"https://{config['AUTH0_DOMAIN']}/.well-known/jwks.json"
+    verifier = TokenVerifier(
+        config['AUTH0_DOMAIN'],
+        config['API_AUDIENCE'],
+        config['ALGORITHMS'],
+        JWKSCache(
+            jwks_url,
+            ttl=config['JWKS_TTL'],
+            refresh_interval=config['JWKS_REFRESH_INTERVAL'],
+            timeout=config['JWKS_TIMEOUT']
+        ),
+        TokenCache(config['TOKEN_CACHE_SIZE']),
+        config.get('ROLES_CLAIM')
+    )
+    app.extensions['auth'] = verifier
+    return verifier
+
+
+def requires_auth(permission='', any_of=False):
+    '''Require a bearer token granting permission
 
+    permission is a name or a collection of names, all of which (or, with
+    any_of, at least one of which) must be granted.
+    '''
+    required = permission_set(permission)
 
-def requires_auth(permission=''):
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
-            check_permissions(permission, payload)
+            try:
+                with timed('auth'):
+                    token = get_token_auth_header()
+                    verifier = current_app.extensions['auth']
+                    payload, permissions = verifier.authenticate(token)
+                    check_granted(required, permissions, any_of)
+            except AuthError as e:
+                AUTH_FAILURES.inc(code=e.error['code'])
+                raise
             return f(*args, **kwargs)
 
         return wrapper
@@ -0,0 +1,48 @@
+'''Compare cold and warm per-request auth overhead
+
+Cold requests verify the RSA signature; warm requests reuse the verified
+token cache. The JWKS is served from a local file in both cases.
+
+    $ python -m benchmarks.auth [iterations]
+'''
+import os
+import sys
+import tempfile
+import timeit
+from benchmarks.idp import ALGORITHM, LocalIdP
+
+
+def main(iterations=2000):
+    idp = LocalIdP()
+    fd, path = tempfile.mkstemp(suffix='.json')
+    os.close(fd)
+    jwks_url = idp.write_jwks(path)
+
+    import auth
+    from flask import Flask
+
+    app = Flask(__name__)
+    verifier = auth.TokenVerifier(
+        idp.domain, idp.audience, ALGORITHM, auth.JWKSCache(jwks_url))
+    app.extensions['auth'] = verifier
+    view = auth.requires_auth('get:actors')(lambda: None)
+    headers = {'Authorization': 'Bearer ' + idp.issue(['get:actors'])}
+
+    def cold():
+        verifier.tokens.clear()
+        view()
+
+    with app.test_request_context(headers=headers):
+        view()
+        cold_time = min(timeit.repeat(cold, number=iterations, repeat=3))
+        warm_time = min(timeit.repeat(view, number=iterations, repeat=3))
+    os.remove(path)
+
+    cold_us = cold_time / iterations * 1e6
+    warm_us = warm_time / iterations * 1e6
+    print(f'cold: {cold_us:9.1f} us/request')
+    print(f'warm: {warm_us:9.1f} us/request ({cold_us / warm_us:.0f}x)')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,163 @@
+'''Local stand-in for the Auth0 identity provider
+
+Run it as a JWKS server for an app started in another process:
+
+    $ python -m benchmarks.idp key.pem [port]
+
+The keypair is saved to key.pem (or loaded from it, if it exists) so that
+benchmarks.load --key key.pem issues tokens the app accepts. The
+environment the app needs and a token for each role are printed.
+'''
+import json
+import os
+import sys
+import threading
+import time
+import rsa
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from jose import jwk, jwt
+
+DOMAIN = 'agency.local'
+AUDIENCE = 'casting-agency'
+ALGORITHM = 'RS256'
+JWKS_PATH = '/.well-known/jwks.json'
+ROLES = ('casting-assistant', 'casting-director', 'executive-producer')
+
+
+class LocalIdP:
+    '''Sign access tokens with a throwaway RSA keypair, or the keypair in
+    private_key (PKCS#1 PEM) if given'''
+    def __init__(self, kid='local', domain=DOMAIN, audience=AUDIENCE,
+                 private_key=None):
+        if private_key is None:
+            public_key, private_key = rsa.newkeys(2048)
+        else:
+            private_key = rsa.PrivateKey.load_pkcs1(private_key.encode())
+            public_key = rsa.PublicKey(private_key.n, private_key.e)
+        self.kid = kid
+        self.domain = domain
+        self.audience = audience
+        self.private_key = private_key.save_pkcs1().decode()
+        self.public_jwk = dict(
+            jwk.construct(public_key.save_pkcs1().decode(), ALGORITHM)
+            .to_dict(),
+            kid=kid,
+            use='sig'
+        )
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        '''Return an identity provider signing with the keypair saved at
+        path, saving a new keypair there if there is none'''
+        if os.path.exists(path):
+            with open(path) as f:
+                return cls(private_key=f.read(), **kwargs)
+        idp = cls(**kwargs)
+        with open(path, 'w') as f:
+            f.write(idp.private_key)
+        return idp
+
+    def jwks(self):
+        '''Return the JSON Web Key Set'''
+        return {'keys': [self.public_jwk]}
+
+    def write_jwks(self, path):
+        '''Write the JSON Web Key Set to path and return its file URL'''
+        with open(path, 'w') as f:
+            json.dump(self.jwks(), f)
+        return 'file://' + os.path.abspath(path)
+
+    def environment(self, jwks_url):
+        '''Return the environment pointing auth at this identity provider'''
+        return {
+            'AUTH0_DOMAIN': self.domain,
+            'API_AUDIENCE': self.audience,
+            'ALGORITHMS': ALGORITHM,
+            'JWKS_URL': jwks_url
+        }
+
+    def configure_environment(self, jwks_url):
+        '''Point create_app at this identity provider'''
+        os.environ.update(self.environment(jwks_url))
+
+    def issue(self, permissions, ttl=3600, **claims):
+        '''Return a signed access token granting permissions'''
+        now = int(time.time())
+        claims = dict({
+            'iss': f'https://{self.domain}/',
+            'sub': 'local|benchmark',
+            'aud': self.audience,
+            'iat': now,
+            'exp': now + ttl,
+            'permissions': list(permissions)
+        }, **claims)
+        return jwt.encode(claims, self.private_key, algorithm=ALGORITHM,
+                          headers={'kid': self.kid})
+
+    def issue_role(self, role, ttl=3600, **claims):
+        '''Return a signed access token granting the permissions of role'''
+        from auth import ROLE_PERMISSIONS
+        return self.issue(
+            sorted(ROLE_PERMISSIONS[role]), ttl, sub=f'local|{role}',
+            **claims)
+
+
+class JWKSServer:
+    '''Serve the JSON Web Key Set of an identity provider over HTTP from a
+    background thread'''
+    def __init__(self, idp, host='127.0.0.1', port=0):
+        body = json.dumps(idp.jwks()).encode()
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != JWKS_PATH:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        '''Return the JSON Web Key Set URL'''
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}{JWKS_PATH}'
+
+    def start(self):
+        '''Start serving and return the JSON Web Key Set URL'''
+        self.thread.start()
+        return self.url
+
+    def stop(self):
+        '''Stop serving'''
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def main(path='key.pem', port=8765):
+    idp = LocalIdP.load(path)
+    server = JWKSServer(idp, port=int(port))
+    url = server.start()
+    environment = idp.environment(url)
+    os.environ.update(environment)
+    for name, value in environment.items():
+        print(f'export {name}={value}')
+    for role in ROLES:
+        print(f'# {role}: {idp.issue_role(role, ttl=86400)}')
+    try:
+        server.thread.join()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,393 @@
+'''Drive every route with a weighted workload mix and report throughput
+and p50/p95/p99 latency
+
+By default the app runs in process against --database, which defaults
+to BENCH_DATABASE_URL or else a temporary SQLite file, seeded at --scale,
+with tokens verified against a local JWKS server. DATABASE_URL is never
+used. With --url, requests go over HTTP to an app that is already
+seeded (benchmarks.seed) and trusts the JWKS server of
+benchmarks.idp started with the same --key.
+
+Write rows delete what they create, so the seeded data is unchanged and
+runs with the same --seed send the same requests. Save results with
+--json to compare commits.
+
+    $ python -m benchmarks.load [--requests 2000] [--concurrency 4]
+    $ python -m benchmarks.load --url http://localhost:8000 --key key.pem
+'''
+import argparse
+import http.client
+import json
+import random
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+from urllib.parse import urlsplit
+from benchmarks.idp import JWKSServer, LocalIdP, ROLES
+from benchmarks.seed import bench_database_url, parse_scale
+
+RELEASE_DATE = '2099-01-01T00:00:00.000Z'
+
+
+class TestClientTransport:
+    '''Send requests to an app in this process'''
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def send(self, method, path, headers, body):
+        response = self.client.open(
+            path, method=method, headers=headers, json=body)
+        return response.status_code, response.get_json(silent=True)
+
+
+class HTTPTransport:
+    '''Send requests over one keep-alive HTTP connection'''
+    def __init__(self, url):
+        parts = urlsplit(url)
+        self.connection = http.client.HTTPConnection(parts.netloc)
+        self.prefix = parts.path.rstrip('/')
+
+    def send(self, method, path, headers, body):
+        headers = dict(headers)
+        data = None
+        if body is not None:
+            data = json.dumps(body).encode()
+            headers['Content-Type'] = 'application/json'
+        self.connection.request(
+            method, self.prefix + path, body=data, headers=headers)
+        response = self.connection.getresponse()
+        data = response.read()
+        try:
+            return response.status, json.loads(data)
+        except ValueError:
+            return response.status, None
+
+
+class Workload:
+    '''Weighted mix of scenarios, each a sequence of requests'''
+    def __init__(self, transport, tokens, ranges, rng):
+        self.transport = transport
+        self.tokens = tokens
+        self.ranges = ranges
+        self.rng = rng
+        self.results = []
+        self.scenarios = [
+            (self.list_actors, 12),
+            (self.get_actor, 10),
+            (self.get_actor_movies, 6),
+            (self.list_movies, 12),
+            (self.get_movie, 10),
+            (self.get_movie_actors, 6),
+            (self.list_performances, 10),
+            (self.search, 8),
+            (self.actor_writes, 4),
+            (self.movie_writes, 2),
+            (self.bulk_writes, 1),
+            (self.metrics, 1)
+        ]
+
+    def request(self, route, method, path, role=None, body=None):
+        '''Send a request and record its route, status and latency'''
+        headers = {}
+        if role is not None:
+            headers['Authorization'] = 'Bearer ' + self.tokens[role]
+        start = time.perf_counter()
+        status, data = self.transport.send(method, path, headers, body)
+        self.results.append((route, status, time.perf_counter() - start))
+        return data if status == 200 else None
+
+    def run_one(self):
+        '''Run a scenario picked by weight'''
+        scenarios, weights = zip(*self.scenarios)
+        self.rng.choices(scenarios, weights)[0]()
+
+    def random_id(self, table):
+        first, last = self.ranges[table]
+        return self.rng.randint(first, last)
+
+    def unique_name(self, prefix):
+        return f'{prefix} {self.rng.getrandbits(64):016x}'
+
+    def list_actors(self):
+        path = self.rng.choice([
+            '/actors?limit=20',
+            '/actors?limit=20&sort=-age&gender=female',
+            '/actors?limit=20&sort=name&name=actor%201',
+            '/actors?limit=20&min_age=30&max_age=40&fields=id,name'
+        ])
+        self.request('GET /actors', 'GET', path, 'casting-assistant')
+
+    def get_actor(self):
+        self.request(
+            'GET /actors/:id', 'GET', f"/actors/{self.random_id('actors')}",
+            'casting-assistant')
+
+    def get_actor_movies(self):
+        self.request(
+            'GET /actors/:id/movies', 'GET',
+            f"/actors/{self.random_id('actors')}/movies",
+            'casting-assistant')
+
+    def list_movies(self):
+        path = self.rng.choice([
+            '/movies?limit=20',
+            '/movies?limit=20&sort=-release_date',
+            '/movies?limit=20&min_release_date=2030-06-01T00:00:00.000Z',
+            '/movies?limit=20&sort=title&title=movie%202'
+        ])
+        self.request('GET /movies', 'GET', path, 'casting-assistant')
+
+    def get_movie(self):
+        self.request(
+            'GET /movies/:id', 'GET', f"/movies/{self.random_id('movies')}",
+            'casting-assistant')
+
+    def get_movie_actors(self):
+        self.request(
+            'GET /movies/:id/actors', 'GET',
+            f"/movies/{self.random_id('movies')}/actors",
+            'casting-assistant')
+
+    def list_performances(self):
+        path = self.rng.choice([
+            '/performances?limit=50',
+            '/performances?limit=50&expand=actor,movie'
+        ])
+        self.request('GET /performances', 'GET', path, 'casting-assistant')
+
+    def search(self):
+        q = self.rng.choice(['ac', 'actor%2012', 'movie%203', 'mo', 'tor%207'])
+        self.request('GET /search', 'GET', f'/search?q={q}&limit=10',
+                     'casting-assistant')
+
+    def metrics(self):
+        self.request('GET /', 'GET', '/')
+        self.request('GET /metrics', 'GET', '/metrics')
+
+    def actor_writes(self):
+        data = self.request(
+            'POST /actors', 'POST', '/actors', 'casting-director', {
+                'name': self.unique_name('Load actor'),
+                'gender': 'female',
+                'age': self.rng.randint(18, 90)
+            })
+        if data is None:
+            return
+        actor_id = data['actor']['id']
+        self.request(
+            'PATCH /actors/:id', 'PATCH', f'/actors/{actor_id}',
+            'casting-director', {'age': self.rng.randint(18, 90)})
+        data = self.request(
+            'POST /performances', 'POST', '/performances',
+            'casting-director', {
+                'actor_id': actor_id,
+                'movie_id': self.random_id('movies')
+            })
+        if data is not None:
+            self.request(
+                'DELETE /performances/:id', 'DELETE',
+                f"/performances/{data['performance']['id']}",
+                'casting-director')
+        self.request(
+            'DELETE /actors/:id', 'DELETE', f'/actors/{actor_id}',
+            'casting-director')
+
+    def movie_writes(self):
+        data = self.request(
+            'POST /movies', 'POST', '/movies', 'executive-producer', {
+                'title': self.unique_name('Load movie'),
+                'release_date': RELEASE_DATE
+            })
+        if data is None:
+            return
+        movie_id = data['movie']['id']
+        self.request(
+            'PATCH /movies/:id', 'PATCH', f'/movies/{movie_id}',
+            'executive-producer', {'title': self.unique_name('Load movie')})
+        self.request(
+            'DELETE /movies/:id', 'DELETE', f'/movies/{movie_id}',
+            'executive-producer')
+
+    def bulk_writes(self, size=5):
+        actors = self.request(
+            'POST /actors/bulk', 'POST', '/actors/bulk',
+            'executive-producer', [{
+                'name': self.unique_name('Load actor'),
+                'gender': 'male',
+                'age': 40
+            } for _ in range(size)])
+        movies = self.request(
+            'POST /movies/bulk', 'POST', '/movies/bulk',
+            'executive-producer', [{
+                'title': self.unique_name('Load movie'),
+                'release_date': RELEASE_DATE
+            } for _ in range(size)])
+        actor_ids = [result['actor']['id']
+                     for result in (actors or {}).get('results', [])]
+        movie_ids = [result['movie']['id']
+                     for result in (movies or {}).get('results', [])]
+        if actor_ids and movie_ids:
+            self.request(
+                'POST /performances/bulk', 'POST', '/performances/bulk',
+                'executive-producer', [
+                    {'actor_id': actor_id, 'movie_id': movie_id}
+                    for actor_id, movie_id in zip(actor_ids, movie_ids)
+                ])
+        # Deleting the actors and movies cascades to their performances
+        for actor_id in actor_ids:
+            self.request(
+                'DELETE /actors/:id', 'DELETE', f'/actors/{actor_id}',
+                'executive-producer')
+        for movie_id in movie_ids:
+            self.request(
+                'DELETE /movies/:id', 'DELETE', f'/movies/{movie_id}',
+                'executive-producer')
+
+
+def get_ranges(transport, tokens):
+    '''Return the (first, last) seeded id of actors and movies'''
+    headers = {'Authorization': 'Bearer ' + tokens['casting-assistant']}
+    ranges = {}
+    for table in ('actors', 'movies'):
+        ids = []
+        for sort in ('id', '-id'):
+            status, data = transport.send(
+                'GET', f'/{table}?limit=1&sort={sort}&fields=id', headers,
+                None)
+            if status != 200 or not data[table]:
+                raise SystemExit(f'No {table} to load test: seed first')
+            ids.append(data[table][0]['id'])
+        ranges[table] = tuple(ids)
+    return ranges
+
+
+def get_commit():
+    '''Return the current git commit, or None outside a checkout'''
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+            text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def summarize(results, seconds):
+    '''Return throughput and latency percentiles, overall and by route'''
+    def stats(rows):
+        timings = sorted(row[2] * 1000 for row in rows)
+        if len(timings) > 1:
+            percentiles = statistics.quantiles(timings, n=100)
+        else:
+            percentiles = timings * 99
+        return {
+            'requests': len(rows),
+            'errors': sum(1 for row in rows if row[1] >= 500),
+            'p50_ms': round(percentiles[49], 3),
+            'p95_ms': round(percentiles[94], 3),
+            'p99_ms': round(percentiles[98], 3)
+        }
+
+    routes = {}
+    for row in results:
+        routes.setdefault(row[0], []).append(row)
+    return dict(
+        stats(results),
+        commit=get_commit(),
+        seconds=round(seconds, 3),
+        throughput=round(len(results) / seconds, 1),
+        routes={route: stats(rows) for route, rows in sorted(routes.items())}
+    )
+
+
+def print_summary(summary):
+    print(f"{'route':<28}{'requests':>9}{'5xx':>6}"
+          f"{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    for route, stats in list(summary['routes'].items()) + [
+            ('all', summary)]:
+        print(f"{route:<28}{stats['requests']:>9}{stats['errors']:>6}"
+              f"{stats['p50_ms']:>9.2f}{stats['p95_ms']:>9.2f}"
+              f"{stats['p99_ms']:>9.2f}")
+    print(f"{summary['throughput']:.1f} requests/s over "
+          f"{summary['seconds']:.1f} s at commit {summary['commit']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--url', help='app base URL (default: in process)')
+    parser.add_argument('--key', help='keypair saved by benchmarks.idp')
+    parser.add_argument('--database',
+                        help='database URL in process (default: '
+                             'BENCH_DATABASE_URL or a temporary SQLite file)')
+    parser.add_argument('--scale', default='10k',
+                        help='performances seeded in process')
+    parser.add_argument('--requests', type=int, default=2000,
+                        help='scenarios run in total')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args()
+
+    if args.url:
+        if not args.key:
+            parser.error('--url needs the --key the app trusts')
+        idp = LocalIdP.load(args.key)
+        tokens = {role: idp.issue_role(role) for role in ROLES}
+
+        def transport():
+            return HTTPTransport(args.url)
+    else:
+        idp = LocalIdP.load(args.key) if args.key else LocalIdP()
+        idp.configure_environment(JWKSServer(idp).start())
+        database = args.database or bench_database_url(tempfile.mkdtemp())
+        tokens = {role: idp.issue_role(role) for role in ROLES}
+
+        from app import create_app
+        from benchmarks.seed import seed
+        from models import db
+        app = create_app({'DATABASE_URL': database})
+        with app.app_context():
+            db.create_all()
+            try:
+                with db.engine.begin() as connection:
+                    seed(connection, parse_scale(args.scale))
+            except ValueError:
+                print(f'Using the rows already in {database}')
+
+        def transport():
+            return TestClientTransport(app)
+
+    ranges = get_ranges(transport(), tokens)
+    workloads = [
+        Workload(transport(), tokens, ranges,
+                 random.Random(f'{args.seed}-{i}'))
+        for i in range(args.concurrency)
+    ]
+
+    def run(workload, count):
+        for _ in range(count):
+            workload.run_one()
+
+    threads = [
+        threading.Thread(target=run, args=(
+            workload, len(range(i, args.requests, args.concurrency))))
+        for i, workload in enumerate(workloads)
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - start
+
+    summary = summarize(
+        [row for workload in workloads for row in workload.results], seconds)
+    print_summary(summary)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+'''Compare movie insert latency before and after the lower(title) index
+
+"before" mirrors the old write path: a plain UNIQUE(title) constraint and a
+lower(title) pre-check query (a sequential scan) ahead of every INSERT.
+"after" relies on the unique lower(title) index alone. Both run against
+TEMP tables seeded with rows movies, so Postgres is required.
+
+    $ DATABASE_URL=postgresql://localhost:5432/agency \\
+        python -m benchmarks.movie_inserts [rows] [inserts]
+'''
+import os
+import statistics
+import sys
+import time
+from sqlalchemy import create_engine, text
+
+SCHEMAS = {
+    'before': [
+        'CREATE TEMP TABLE movies_before ('
+        'id serial PRIMARY KEY, '
+        'title varchar(120) NOT NULL UNIQUE, '
+        'release_date timestamp NOT NULL)'
+    ],
+    'after': [
+        'CREATE TEMP TABLE movies_after ('
+        'id serial PRIMARY KEY, '
+        'title varchar(120) NOT NULL, '
+        'release_date timestamp NOT NULL)',
+        'CREATE UNIQUE INDEX ON movies_after (lower(title))'
+    ]
+}
+
+
+def seed(connection, table, rows):
+    for statement in SCHEMAS[table]:
+        connection.execute(text(statement))
+    connection.execute(text(
+        f'INSERT INTO movies_{table} (title, release_date) '
+        "SELECT 'Movie ' || g, now() + interval '1 year' "
+        'FROM generate_series(1, :rows) g'
+    ), {'rows': rows})
+    connection.execute(text(f'ANALYZE movies_{table}'))
+
+
+def insert(connection, table, title):
+    with connection.begin():
+        if table == 'before':
+            duplicate = connection.execute(text(
+                'SELECT id FROM movies_before '
+                'WHERE lower(title) = lower(:title) LIMIT 1'
+            ), {'title': title}).first()
+            if duplicate is not None:
+                return
+        connection.execute(text(
+            f'INSERT INTO movies_{table} (title, release_date) '
+            "VALUES (:title, now() + interval '1 year')"
+        ), {'title': title})
+
+
+def main(rows=1000000, inserts=200):
+    database_path = os.environ['DATABASE_URL'].replace(
+        'postgres://', 'postgresql://', 1)
+    engine = create_engine(database_path)
+    with engine.connect() as connection:
+        for table in ('before', 'after'):
+            with connection.begin():
+                seed(connection, table, rows)
+            timings = []
+            for i in range(inserts):
+                start = time.perf_counter()
+                insert(connection, table, f'New Movie {i}')
+                timings.append((time.perf_counter() - start) * 1000)
+            percentiles = statistics.quantiles(timings, n=100)
+            p50, p99 = percentiles[49], percentiles[98]
+            print(f'{table:>6}: {rows} rows, {inserts} inserts, '
+                  f'p50 {p50:.2f} ms, p99 {p99:.2f} ms, '
+                  f'{inserts / sum(timings) * 1000:.0f} inserts/s')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
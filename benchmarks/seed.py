@@ -0,0 +1,140 @@
+'''Seed actors, movies and performances for benchmarks
+
+scale is the number of performances, such as 10k, 1M or 10M. By default
+one actor and one movie are seeded per ten performances, and every
+performance pairs a distinct actor and movie. The rows only depend on
+scale, so every run seeds the same data. The tables must be empty.
+
+The database is BENCH_DATABASE_URL, or else agency.db in the working
+directory; DATABASE_URL is never used. Missing tables are created, but
+run the migrations first on a database you will serve the app from.
+
+    $ BENCH_DATABASE_URL=postgresql://localhost:5432/agency_bench \\
+        python -m benchmarks.seed [scale]
+'''
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import func, select, text
+from sqlalchemy.engine import make_url
+
+GENDERS = ('female', 'male', 'non-binary')
+FIRST_RELEASE_DATE = datetime(2030, 1, 1)
+CHUNK_SIZE = 10000
+SUFFIXES = {'k': 10 ** 3, 'm': 10 ** 6}
+
+POSTGRESQL_STATEMENTS = {
+    'actors': '''INSERT INTO actors (name, gender, age)
+        SELECT 'Actor ' || g,
+            (ARRAY['female', 'male', 'non-binary'])[g % 3 + 1], 18 + g % 70
+        FROM generate_series(0, :count - 1) g''',
+    'movies': '''INSERT INTO movies (title, release_date)
+        SELECT 'Movie ' || g, :first_release_date + g * interval '1 hour'
+        FROM generate_series(0, :count - 1) g''',
+    'performances': '''INSERT INTO performances (actor_id, movie_id)
+        SELECT :first_actor_id + g % :actors,
+            :first_movie_id + (g / :actors) % :movies
+        FROM generate_series(0, :count - 1) g'''
+}
+
+
+def parse_scale(value):
+    '''Parse a count such as 10000, 10k or 1M'''
+    multiplier = SUFFIXES.get(value[-1:].lower())
+    if multiplier is None:
+        return int(value)
+    return int(float(value[:-1]) * multiplier)
+
+
+def bench_database_url(directory):
+    '''Return BENCH_DATABASE_URL, or else a SQLite file in directory
+
+    DATABASE_URL is never used, as it may point at production.
+    '''
+    return os.environ.get('BENCH_DATABASE_URL') or \
+        'sqlite:///' + os.path.join(directory, 'agency.db')
+
+
+def actor_row(i):
+    '''Return the i-th seeded actor'''
+    return {'name': f'Actor {i}', 'gender': GENDERS[i % 3], 'age': 18 + i % 70}
+
+
+def movie_row(i):
+    '''Return the i-th seeded movie'''
+    return {
+        'title': f'Movie {i}',
+        'release_date': FIRST_RELEASE_DATE + timedelta(hours=i)
+    }
+
+
+def performance_row(i, first_actor_id, actors, first_movie_id, movies):
+    '''Return the i-th seeded performance'''
+    return {
+        'actor_id': first_actor_id + i % actors,
+        'movie_id': first_movie_id + (i // actors) % movies
+    }
+
+
+def insert(connection, table, count, row, **params):
+    '''Insert count rows into table, row(i, **params) in Python chunks or
+    with generate_series on PostgreSQL'''
+    if connection.dialect.name == 'postgresql':
+        connection.execute(text(POSTGRESQL_STATEMENTS[table.name]), dict(
+            params, count=count, first_release_date=FIRST_RELEASE_DATE))
+        return
+    for start in range(0, count, CHUNK_SIZE):
+        connection.execute(table.insert(), [
+            row(i, **params)
+            for i in range(start, min(start + CHUNK_SIZE, count))
+        ])
+
+
+def seed(connection, performances, actors=None, movies=None):
+    '''Seed performances, by default pairing performances // 10 actors
+    with as many movies, and return the row counts by table'''
+    from models import Actor, Movie, Performance
+    if actors is None:
+        actors = max(performances // 10, 10)
+    if movies is None:
+        movies = actors
+    performances = min(performances, actors * movies)
+    for model in (Actor, Movie, Performance):
+        if connection.execute(select(func.count()).select_from(
+                model.__table__)).scalar():
+            raise ValueError(f'{model.__tablename__} is not empty')
+    insert(connection, Actor.__table__, actors, actor_row)
+    insert(connection, Movie.__table__, movies, movie_row)
+    first_actor_id = connection.execute(select(func.min(Actor.id))).scalar()
+    first_movie_id = connection.execute(select(func.min(Movie.id))).scalar()
+    insert(
+        connection,
+        Performance.__table__,
+        performances,
+        performance_row,
+        first_actor_id=first_actor_id,
+        actors=actors,
+        first_movie_id=first_movie_id,
+        movies=movies
+    )
+    return {'actors': actors, 'movies': movies, 'performances': performances}
+
+
+def main(scale='10k'):
+    from app import create_app
+    from models import db
+    database = bench_database_url(os.getcwd())
+    app = create_app({'DATABASE_URL': database})
+    with app.app_context():
+        db.create_all()
+        start = time.perf_counter()
+        with db.engine.begin() as connection:
+            counts = seed(connection, parse_scale(scale))
+        seconds = time.perf_counter() - start
+    print(', '.join(f'{count} {table}' for table, count in counts.items())
+          + f' in {seconds:.1f} s into {make_url(database)!r}')
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
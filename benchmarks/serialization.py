@@ -0,0 +1,64 @@
+'''Measure GET /performances latency for a 10k-row page
+
+Each JSON provider is timed with every available response encoding. The
+app runs in process against a temporary SQLite file, or the empty
+scratch database in BENCH_DATABASE_URL to measure Postgres. DATABASE_URL
+is never used.
+
+    $ python -m benchmarks.serialization [rows] [requests]
+'''
+import os
+import statistics
+import sys
+import tempfile
+import time
+from benchmarks.idp import LocalIdP
+from benchmarks.seed import bench_database_url, seed
+
+
+def main(rows=10000, requests=50):
+    idp = LocalIdP()
+    directory = tempfile.mkdtemp()
+    idp.configure_environment(
+        idp.write_jwks(os.path.join(directory, 'jwks.json')))
+    database = bench_database_url(directory)
+
+    from app import create_app
+    from helpers import COMPRESSORS
+    from models import db
+
+    headers = {'Authorization': 'Bearer ' + idp.issue(['get:performances'])}
+    path = f'/performances?limit={rows}'
+    seeded = False
+    for provider in ('json', 'orjson'):
+        for encoding in ['identity'] + sorted(COMPRESSORS):
+            app = create_app({
+                'DATABASE_URL': database,
+                'MAX_PAGE_SIZE': rows,
+                'JSON_PROVIDER': provider,
+                'CACHE_TYPE': 'null'
+            })
+            client = app.test_client()
+            with app.app_context():
+                if not seeded:
+                    db.create_all()
+                    side = int(rows ** 0.5) + 1
+                    with db.engine.begin() as connection:
+                        seed(connection, rows, side, side)
+                    seeded = True
+                request_headers = dict(headers, **{
+                    'Accept-Encoding': encoding})
+                size = len(client.get(path, headers=request_headers).data)
+                timings = []
+                for _ in range(requests):
+                    start = time.perf_counter()
+                    client.get(path, headers=request_headers)
+                    timings.append((time.perf_counter() - start) * 1000)
+            percentiles = statistics.quantiles(timings, n=100)
+            p50, p99 = percentiles[49], percentiles[98]
+            print(f'{provider:>6} {encoding:>8}: {rows} rows, '
+                  f'p50 {p50:7.2f} ms, p99 {p99:7.2f} ms, {size} bytes')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,99 @@
+'''Time a cold start: importing app, create_app and the first request
+
+Each sample starts a fresh interpreter, as a dyno restart does. The
+first request either fetches the signing keys and connects to the
+database on demand (cold) or follows warm_up, as a preloaded gunicorn
+worker does (warm). Keys are served by a local stand-in for Auth0, so a
+real key fetch costs more. The database is a temporary SQLite file
+seeded with 1k performances, or the scratch database in
+BENCH_DATABASE_URL. DATABASE_URL is never used.
+
+    $ python -m benchmarks.startup [samples]
+'''
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from benchmarks.idp import JWKSServer, LocalIdP
+from benchmarks.seed import bench_database_url, seed
+
+PHASES = ('import', 'create_app', 'warm_up', 'first_request')
+
+
+def child(mode):
+    '''Run one start in this interpreter and print its phases in ms'''
+    timings = {}
+    start = time.perf_counter()
+    from app import create_app, warm_up
+    timings['import'] = time.perf_counter() - start
+    mark = time.perf_counter()
+    app = create_app()
+    timings['create_app'] = time.perf_counter() - mark
+    mark = time.perf_counter()
+    if mode == 'warm':
+        warm_up(app, 1)
+    timings['warm_up'] = time.perf_counter() - mark
+    mark = time.perf_counter()
+    response = app.test_client().get('/actors?limit=10', headers={
+        'Authorization': 'Bearer ' + os.environ['STARTUP_TOKEN']
+    })
+    timings['first_request'] = time.perf_counter() - mark
+    if response.status_code != 200:
+        raise SystemExit(f'GET /actors returned {response.status_code}')
+    print(json.dumps({
+        phase: seconds * 1000 for phase, seconds in timings.items()}))
+
+
+def run(mode, environment):
+    '''Start a child interpreter and return its phases in ms'''
+    start = time.perf_counter()
+    output = subprocess.run(
+        [sys.executable, '-m', 'benchmarks.startup', 'child', mode],
+        env=environment, stdout=subprocess.PIPE, check=True
+    ).stdout
+    timings = json.loads(output)
+    timings['process'] = (time.perf_counter() - start) * 1000
+    return timings
+
+
+def main(samples=10):
+    idp = LocalIdP()
+    server = JWKSServer(idp)
+    environment = dict(os.environ, **idp.environment(server.start()))
+    environment['STARTUP_TOKEN'] = idp.issue_role('casting-assistant')
+    environment['DATABASE_URL'] = bench_database_url(tempfile.mkdtemp())
+
+    from app import create_app
+    from models import db
+    app = create_app({'DATABASE_URL': environment['DATABASE_URL']})
+    with app.app_context():
+        db.create_all()
+        try:
+            with db.engine.begin() as connection:
+                seed(connection, 1000)
+        except ValueError:
+            pass
+        db.engine.dispose()
+
+    # Alternate modes so that drift on the host affects both alike
+    results = {'cold': [], 'warm': []}
+    for _ in range(samples):
+        for mode in results:
+            results[mode].append(run(mode, environment))
+    print(f'{"median ms":<10}' + ''.join(
+        f'{phase:>15}' for phase in PHASES + ('process',)))
+    for mode in results:
+        print(f'{mode:<10}' + ''.join(
+            f'{statistics.median(r[phase] for r in results[mode]):15.1f}'
+            for phase in PHASES + ('process',)))
+    server.stop()
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['child']:
+        child(*sys.argv[2:])
+    else:
+        main(*map(int, sys.argv[1:]))
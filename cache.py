@@ -0,0 +1,157 @@
+import threading
+import time
+from collections import OrderedDict
+from flask import request, Response
+from functools import wraps
+from urllib.parse import urlencode
+from helpers import wants_stream
+from metrics import Counter
+
+CACHE_REQUESTS = Counter(
+    'agency_response_cache_requests_total',
+    'Response cache lookups by endpoint and result',
+    ('endpoint', 'result')
+)
+
+
+class CacheBackend:
+    '''Storage interface for the response cache, whose values are bytes'''
+
+    def get(self, key):
+        '''Return the value stored at key, or None'''
+        raise NotImplementedError
+
+    def set(self, key, value, ttl):
+        '''Store value at key for ttl seconds'''
+        raise NotImplementedError
+
+
+class NullBackend(CacheBackend):
+    '''Backend that stores nothing, disabling the cache'''
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value, ttl):
+        pass
+
+
+class LocalBackend(CacheBackend):
+    '''In-process LRU backend, holding a separate copy in every worker'''
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        '''Drop every entry'''
+        with self._lock:
+            self._entries.clear()
+
+
+class SharedBackend(CacheBackend):
+    '''Backend on a shared key-value store such as Redis
+
+    client needs the get and set (with ex) methods of a redis.Redis
+    client.
+    '''
+
+    def __init__(self, client, prefix='agency:'):
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def set(self, key, value, ttl):
+        self.client.set(self.prefix + key, value, ex=max(1, int(ttl)))
+
+
+def create_backend(config):
+    '''Return the cache backend selected by CACHE_TYPE'''
+    type = config['CACHE_TYPE']
+    if type == 'null':
+        return NullBackend()
+    if type == 'local':
+        return LocalBackend(config['CACHE_SIZE'])
+    if type == 'redis':
+        import redis
+        return SharedBackend(redis.Redis.from_url(config['CACHE_REDIS_URL']))
+    raise ValueError(f'unknown cache type {type!r}')
+
+
+class ResponseCache:
+    '''Read-through cache of successful JSON GET responses
+
+    Keys hold the route, the query string arguments and the version of
+    each table the response was read from, as returned by
+    get_versions(tables). A write that bumps a table version makes every
+    dependent entry unreachable. With a NullBackend the views are called
+    directly, without reading the versions.
+    '''
+
+    def __init__(self, backend, get_versions, ttl=300):
+        self.backend = backend
+        self.get_versions = get_versions
+        self.ttl = ttl
+        self.enabled = not isinstance(backend, NullBackend)
+
+    def key(self, tables):
+        '''Return the cache key of the current request'''
+        versions = self.get_versions(tables)
+        # Encoded so that an & or = inside a value cannot pass for another
+        # argument
+        args = urlencode(sorted(request.args.items(multi=True)))
+        stamp = ','.join(
+            f'{table}={version}' for table, version in zip(tables, versions))
+        return f'{request.path}?{args}#{stamp}'
+
+    def cached(self, *tables):
+        '''Decorator caching the view's response until one of tables is
+        written; streamed requests always reach the view'''
+        def cached_decorator(f):
+            @wraps(f)
+            def wrapper(*args, **kwargs):
+                if (not self.enabled or request.method != 'GET'
+                        or wants_stream(request)):
+                    return f(*args, **kwargs)
+                key = self.key(tables)
+                body = self.backend.get(key)
+                if body is not None:
+                    CACHE_REQUESTS.inc(endpoint=request.endpoint, result='hit')
+                    response = Response(body, mimetype='application/json')
+                    response.headers['X-Cache'] = 'HIT'
+                    return response
+                CACHE_REQUESTS.inc(endpoint=request.endpoint, result='miss')
+                response = f(*args, **kwargs)
+                if (isinstance(response, Response)
+                        and response.status_code == 200
+                        and not response.is_streamed
+                        and response.mimetype == 'application/json'):
+                    self.backend.set(key, response.get_data(), self.ttl)
+                    response.headers['X-Cache'] = 'MISS'
+                return response
+            return wrapper
+        return cached_decorator
@@ -0,0 +1,42 @@
+'''gunicorn settings, read from the working directory
+
+The app is built once in the master and warmed up before the workers
+are forked: they start with the modules imported, the signing keys
+fetched and the engine set up, then each opens its own DB_POOL_SIZE
+connections.
+
+    $ gunicorn 'app:create_app()'
+'''
+import glob
+import os
+
+preload_app = True
+
+
+def on_starting(server):
+    '''Drop the metric snapshots of a previous run'''
+    directory = os.environ.get('METRICS_DIR')
+    if directory:
+        for path in glob.glob(os.path.join(directory, '*.json')):
+            os.remove(path)
+
+
+def when_ready(server):
+    '''Warm the app up in the master, closing its connections'''
+    from app import warm_up
+    keys = warm_up(server.app.wsgi())
+    server.log.info('Warmed up with %d signing keys', keys)
+
+
+def post_fork(server, worker):
+    '''Drop the metrics recorded by the master, which every worker would
+    otherwise report again, start writing those of the new worker even
+    while idle, and fill its pool'''
+    from app import warm_up
+    from metrics import reset
+    reset()
+    app = worker.app.wsgi()
+    exporter = app.extensions['metrics_exporter']
+    if exporter is not None:
+        exporter.start()
+    warm_up(app, app.config['DB_POOL_SIZE'])
@@ -1,42 +1,342 @@
+import base64
+import binascii
+import gzip
+import json
 from datetime import datetime
-from schema import And, Const, Optional, Schema, SchemaError, Use
+from flask import current_app
+from profiling import timed
+from schema import And, Optional, SchemaError, Use
+from sqlalchemy import tuple_
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+
+
+def parse_date(value):
+    '''Parse a request datetime string'''
+    return datetime.strptime(value, DATE_FORMAT)
+
+
+def format_date(value):
+    '''Format a UTC datetime as an ISO 8601 string that parse_date reads'''
+    return value.isoformat(timespec='milliseconds') + 'Z'
+
+
+class Fields:
+    '''Validate a JSON object as Schema does for a dict of plain and
+    Optional keys, and return the validated values
+
+    Schema tries each data key against every schema key, building a Schema
+    and a SchemaError per failed try; here each key is looked up instead.
+    '''
+    def __init__(self, fields):
+        self.validators = {
+            getattr(key, 'schema', key): value
+            for key, value in fields.items()
+        }
+        self.required = frozenset(
+            key for key in fields if not isinstance(key, Optional))
+
+    def validate(self, data):
+        if not isinstance(data, dict):
+            raise SchemaError(f'{data!r} should be an object')
+        missing = self.required.difference(data)
+        if missing:
+            raise SchemaError(f'Missing keys: {", ".join(sorted(missing))}')
+        validated = {}
+        for key, value in data.items():
+            validator = self.validators.get(key)
+            if validator is None:
+                raise SchemaError(f'Wrong key {key!r}')
+            validated[key] = validator.validate(value)
+        return validated
+
+
+TEXT = And(Use(str), lambda s: 1 <= len(s) <= 120)
+AGE = And(Use(int), lambda n: 1 <= n <= 99)
+FUTURE_DATE = And(Use(str), Use(parse_date), lambda d: d > datetime.now())
+ID = And(Use(int), lambda n: 1 <= n)
+
+VALIDATORS = {
+    'post-actor': Fields({
+        'name': TEXT,
+        'gender': TEXT,
+        'age': AGE
+    }),
+    'patch-actor': Fields({
+        Optional('name'): TEXT,
+        Optional('gender'): TEXT,
+        Optional('age'): AGE
+    }),
+    'post-movie': Fields({
+        'title': TEXT,
+        'release_date': FUTURE_DATE
+    }),
+    'patch-movie': Fields({
+        Optional('title'): TEXT,
+        Optional('release_date'): FUTURE_DATE
+    }),
+    'post-performance': Fields({
+        'actor_id': ID,
+        'movie_id': ID
+    })
+}
 
 
 def validate_schema(data, type):
-    '''Check data schema is valid'''
-    if type == 'post-actor':
-        schema = Schema({
-            'name': And(Use(str), lambda s: 1 <= len(s) <= 120),
-            'gender': And(Use(str), lambda s: 1 <= len(s) <= 120),
-            'age': And(Use(int), lambda n: 1 <= n <= 99)
-        })
-    elif type == 'patch-actor':
-        schema = Schema({
-            Optional('name'): And(Use(str), lambda s: 1 <= len(s) <= 120),
-            Optional('gender'): And(Use(str), lambda s: 1 <= len(s) <= 120),
-            Optional('age'): And(Use(int), lambda n: 1 <= n <= 99)
-        })
-    elif type == 'post-movie':
-        schema = Schema({
-            'title': And(Use(str), lambda s: 1 <= len(s) <= 120),
-            'release_date':
-                And(Use(str), lambda d: datetime.strptime(
-                    d, '%Y-%m-%dT%H:%M:%S.%fZ') > datetime.now())
-        })
-    elif type == 'patch-movie':
-        schema = Schema({
-            Optional('title'): And(Use(str), lambda s: 1 <= len(s) <= 120),
-            Optional('release_date'):
-                And(Use(str), lambda d: datetime.strptime(
-                    d, '%Y-%m-%dT%H:%M:%S.%fZ') > datetime.now())
-        })
-    elif type == 'post-performance':
-        schema = Schema({
-            'actor_id': And(Use(int), lambda n: 1 <= n),
-            'movie_id': And(Use(int), lambda n: 1 <= n)
-        })
+    '''Return data validated and coerced by the schema for type, or None
+    if data is not valid'''
     try:
-        schema.validate(data)
-        return True
+        schema = VALIDATORS[type]
+    except KeyError:
+        raise ValueError(f'Unknown schema type: {type}')
+    try:
+        with timed('validate'):
+            return schema.validate(data)
     except SchemaError:
-        return False
+        return None
+
+
+def encode_cursor(values):
+    '''Return an opaque pagination cursor for keyset values'''
+    data = json.dumps(values, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(data).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    '''Return keyset values from a pagination cursor, or None if not valid'''
+    try:
+        data = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(data)
+    except (binascii.Error, ValueError):
+        return None
+    if not isinstance(values, list):
+        return None
+    return values
+
+
+def get_page_args(args, columns, default_limit, max_limit):
+    '''Return (after, limit) from query string args, where after holds a
+    value of each of columns, or None if not valid'''
+    try:
+        limit = int(args.get('limit', default_limit))
+    except ValueError:
+        return None
+    if not 1 <= limit <= max_limit:
+        return None
+    cursor = args.get('cursor')
+    if cursor is None:
+        return None, limit
+    values = decode_cursor(cursor)
+    if values is None or len(values) != len(columns):
+        return None
+    after = []
+    for column, value in zip(columns, values):
+        python_type = column.type.python_type
+        if python_type is datetime and type(value) is str:
+            try:
+                value = parse_date(value)
+            except ValueError:
+                return None
+        elif type(value) is not python_type:
+            return None
+        after.append(value)
+    return after, limit
+
+
+def get_search_args(args, default_limit, max_limit):
+    '''Return (q, limit) from query string args, or None if not valid'''
+    q = args.get('q', '').strip()
+    if not 1 <= len(q) <= 120:
+        return None
+    try:
+        limit = int(args.get('limit', default_limit))
+    except ValueError:
+        return None
+    if not 1 <= limit <= max_limit:
+        return None
+    return q, limit
+
+
+def get_sort_args(args, allowed):
+    '''Return (name, descending) from the sort query string argument, a
+    name from allowed with an optional - prefix, or None if not valid'''
+    sort = args.get('sort', 'id')
+    name = sort[1:] if sort.startswith('-') else sort
+    if name not in allowed:
+        return None
+    return name, sort.startswith('-')
+
+
+def get_filter_args(args, filters):
+    '''Return SQL criteria for the query string arguments named in filters,
+    which maps each name to (coerce, criterion), or None if a value is not
+    valid'''
+    criteria = []
+    for name, (coerce, criterion) in filters.items():
+        value = args.get(name)
+        if value is None:
+            continue
+        try:
+            criteria.append(criterion(coerce(value)))
+        except ValueError:
+            return None
+    return criteria
+
+
+def order_by(columns, descending=False):
+    '''Return the order_by clauses for columns in one direction'''
+    return [column.desc() if descending else column for column in columns]
+
+
+def paginate(query, columns, after, limit, descending=False):
+    '''Return a keyset page of query rows ordered by columns and the cursor
+    of the next page (None on the last page)
+
+    columns must end with a unique column so that the page boundary is
+    exact.
+    '''
+    if after is not None:
+        if len(columns) == 1:
+            keys, values = columns[0], after[0]
+        else:
+            keys, values = tuple_(*columns), tuple_(*after)
+        query = query.filter(keys < values if descending else keys > values)
+    rows = query.order_by(*order_by(columns, descending)).limit(
+        limit + 1).all()
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    values = [getattr(rows[-1], column.key) for column in columns]
+    return rows, encode_cursor([
+        value.strftime(DATE_FORMAT) if isinstance(value, datetime) else value
+        for value in values
+    ])
+
+
+def wants_stream(request):
+    '''Check whether a request asks for a streamed NDJSON export'''
+    if request.args.get('stream') in ('1', 'true'):
+        return True
+    return request.accept_mimetypes.best_match(
+        ['application/json', 'application/x-ndjson']
+    ) == 'application/x-ndjson'
+
+
+def generate_ndjson(items, batch_size, dumps):
+    '''Yield items serialized by dumps as newline-delimited JSON,
+    batch_size per chunk'''
+    lines = []
+    for item in items:
+        lines.append(dumps(item))
+        if len(lines) >= batch_size:
+            yield b'\n'.join(lines) + b'\n'
+            lines = []
+    if lines:
+        yield b'\n'.join(lines) + b'\n'
+
+
+def get_expand_args(args, allowed):
+    '''Return the relationships named by the expand query string argument,
+    or None if any is not allowed'''
+    expand = args.get('expand')
+    if not expand:
+        return ()
+    names = tuple(name.strip() for name in expand.split(','))
+    if not set(names) <= set(allowed):
+        return None
+    return names
+
+
+def get_fields_args(args, allowed):
+    '''Return the fields named by the fields query string argument in the
+    order of allowed, all of allowed if it is absent, or None if any is
+    not allowed'''
+    fields = args.get('fields')
+    if fields is None:
+        return allowed
+    names = {name.strip() for name in fields.split(',')}
+    if not names <= set(allowed):
+        return None
+    return tuple(name for name in allowed if name in names)
+
+
+def json_default(value):
+    '''Serialize values the JSON providers do not handle themselves'''
+    if isinstance(value, datetime):
+        return format_date(value)
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def stdlib_dumps(data):
+    '''Serialize data to compact JSON bytes with the json module'''
+    return json.dumps(
+        data, separators=(',', ':'), default=json_default).encode()
+
+
+def orjson_dumps(data):
+    '''Serialize data to compact JSON bytes with orjson'''
+    return orjson.dumps(
+        data, default=json_default, option=orjson.OPT_PASSTHROUGH_DATETIME)
+
+
+def get_json_provider(name, logger=None):
+    '''Return the dumps function of the named JSON provider, falling back
+    to the json module (with a warning on logger) when orjson is not
+    installed'''
+    if name == 'orjson':
+        if orjson is not None:
+            return orjson_dumps
+        if logger is not None:
+            logger.warning('orjson is not installed, serializing with json')
+        return stdlib_dumps
+    if name == 'json':
+        return stdlib_dumps
+    raise ValueError(f'Unknown JSON provider: {name}')
+
+
+def jsonify(data):
+    '''Return data as a JSON response serialized by the app's provider'''
+    with timed('serialize'):
+        body = current_app.extensions['json_dumps'](data)
+    return current_app.response_class(body, mimetype='application/json')
+
+
+COMPRESSORS = {
+    'gzip': lambda data: gzip.compress(data, compresslevel=6)
+}
+if brotli is not None:
+    COMPRESSORS['br'] = lambda data: brotli.compress(data, quality=5)
+
+
+def compress_response(response, accept_encodings, encodings, min_size):
+    '''Compress a response body of at least min_size bytes with the first
+    of encodings the client accepts'''
+    if (response.status_code != 200
+            or response.is_streamed
+            or 'Content-Encoding' in response.headers):
+        return response
+    data = response.get_data()
+    if len(data) < min_size:
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = accept_encodings.best_match(
+        [encoding for encoding in encodings if encoding in COMPRESSORS])
+    if encoding is None:
+        return response
+    response.set_data(COMPRESSORS[encoding](data))
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        # The compressed bytes differ, so the tag is no longer strong
+        response.set_etag(etag, weak=True)
+    return response
@@ -1,11 +1,12 @@
 from flask_script import Manager
 from flask_migrate import Migrate, MigrateCommand
 
-from app import APP
+from app import create_app
 from models import db
 
-manager = Manager(APP)
-migrate = Migrate(APP, db)
+app = create_app()
+manager = Manager(app)
+migrate = Migrate(app, db)
 manager.add_command('db', MigrateCommand)
 
 if __name__ == '__main__':
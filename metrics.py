@@ -0,0 +1,324 @@
+import bisect
+import fcntl
+import json
+import os
+import threading
+import time
+
+REGISTRY = []
+DEAD = 'dead.json'
+
+
+class Metric:
+    '''Named value, optionally split by label values'''
+    type = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=(),
+                 registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def _key(self, labels):
+        return tuple([str(labels[name]) for name in self.labelnames])
+
+    def _add(self, amount, labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        '''Return the value for the given label values'''
+        return self._values.get(self._key(labels), 0)
+
+    def snapshot(self):
+        '''Return a copy of the value of every label combination'''
+        with self._lock:
+            return dict(self._values)
+
+    def reset(self):
+        '''Drop the value of every label combination'''
+        with self._lock:
+            self._values.clear()
+
+    def merge(self, snapshots):
+        '''Return the snapshots of several processes combined'''
+        values = {}
+        for snapshot in snapshots:
+            for key, value in snapshot.items():
+                values[key] = values.get(key, 0) + value
+        return values
+
+    def samples(self, values=None):
+        '''Yield (name, labels, value) for every label combination, from
+        values if given or else from this process'''
+        if values is None:
+            values = self.snapshot()
+        for key, value in values.items():
+            yield self.name, dict(zip(self.labelnames, key)), value
+
+
+class Counter(Metric):
+    '''Monotonic counter, optionally split by label values'''
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        '''Increase the counter for the given label values'''
+        self._add(amount, labels)
+
+
+class Gauge(Metric):
+    '''Value that goes up and down, optionally split by label values
+
+    A gauge with a callback reads its values when rendered: callback
+    returns a dict mapping tuples of label values to values.
+    '''
+    type = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(),
+                 registry=REGISTRY, callback=None):
+        super().__init__(name, documentation, labelnames, registry)
+        self.callback = callback
+
+    def inc(self, amount=1, **labels):
+        '''Increase the gauge for the given label values'''
+        self._add(amount, labels)
+
+    def dec(self, amount=1, **labels):
+        '''Decrease the gauge for the given label values'''
+        self._add(-amount, labels)
+
+    def set(self, value, **labels):
+        '''Set the gauge for the given label values'''
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def snapshot(self):
+        if self.callback is None:
+            return super().snapshot()
+        return self.callback()
+
+
+class Histogram(Metric):
+    '''Distribution of observed values in cumulative buckets, optionally
+    split by label values'''
+    type = 'histogram'
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, documentation, labelnames=(),
+                 registry=REGISTRY, buckets=BUCKETS):
+        super().__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        '''Record value for the given label values'''
+        key = self._key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # One count per bucket, one for +Inf, then the sum
+                counts = self._values[key] = [0] * (len(self.buckets) + 2)
+            counts[i] += 1
+            counts[-1] += value
+
+    def snapshot(self):
+        with self._lock:
+            return {key: list(counts) for key, counts in self._values.items()}
+
+    def merge(self, snapshots):
+        values = {}
+        for snapshot in snapshots:
+            for key, counts in snapshot.items():
+                if key in values:
+                    values[key] = [a + b for a, b in zip(values[key], counts)]
+                else:
+                    values[key] = list(counts)
+        return values
+
+    def samples(self, values=None):
+        if values is None:
+            values = self.snapshot()
+        for key, counts in values.items():
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                yield (self.name + '_bucket',
+                       dict(labels, le=str(bound)), cumulative)
+            yield self.name + '_sum', labels, counts[-1]
+            yield self.name + '_count', labels, cumulative
+
+
+def format_sample(name, labels, value):
+    '''Format a sample in the Prometheus text exposition format'''
+    if labels:
+        pairs = ','.join(
+            '{}="{}"'.format(label, str(label_value)
+                             .replace('\\', '\\\\')
+                             .replace('"', '\\"')
+                             .replace('\n', '\\n'))
+            for label, label_value in labels.items()
+        )
+        name = f'{name}{{{pairs}}}'
+    return f'{name} {value}'
+
+
+def render(registry=REGISTRY, values=None):
+    '''Return every metric in the Prometheus text exposition format, with
+    values mapping metric names to merged snapshots if given'''
+    lines = []
+    for metric in registry:
+        lines.append(f'# HELP {metric.name} {metric.documentation}')
+        lines.append(f'# TYPE {metric.name} {metric.type}')
+        samples = metric.samples(
+            None if values is None else values.get(metric.name, {}))
+        for sample in samples:
+            lines.append(format_sample(*sample))
+    return '\n'.join(lines) + '\n'
+
+
+def reset(registry=REGISTRY):
+    '''Drop the values of every metric, such as those a forked worker
+    inherits from the gunicorn master'''
+    for metric in registry:
+        metric.reset()
+
+
+def is_alive(pid):
+    '''Check whether a process with pid is running on this host'''
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class MultiProcessExporter:
+    '''Share metrics between processes, such as gunicorn workers, through
+    snapshot files in a directory
+
+    Once started, each process writes its snapshot every flush_interval
+    seconds from a daemon thread, whether or not it serves requests, and
+    when it renders. Rendering merges every snapshot: counters and
+    histograms of exited processes are folded into dead.json so totals
+    never go backwards, even when a new process reuses the PID, but
+    gauges only count running processes. Empty the directory before
+    starting the server, then reset the metrics of each forked worker
+    and start it there.
+    '''
+
+    def __init__(self, directory, flush_interval=5, registry=REGISTRY):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.registry = registry
+        self._pid = None
+        self._thread_pid = None
+        self._flush_lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def read(self, name):
+        '''Return the snapshots in the file name by metric name'''
+        with open(os.path.join(self.directory, name)) as f:
+            data = json.load(f)
+        return {
+            metric: {tuple(key): value for key, value in values}
+            for metric, values in data.items()
+        }
+
+    def write(self, name, snapshots):
+        '''Replace the file name with snapshots by metric name'''
+        path = os.path.join(self.directory, name)
+        with open(path + '.tmp', 'w') as f:
+            json.dump({
+                metric: [[list(key), value] for key, value in values.items()]
+                for metric, values in snapshots.items()
+            }, f)
+        os.replace(path + '.tmp', path)
+
+    def archive(self, name):
+        '''Fold the counters and histograms in the file name, written by
+        an exited process, into dead.json and remove it'''
+        with open(os.path.join(self.directory, 'dead.lock'), 'w') as lock:
+            # Another process may be archiving the same file
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                exited = self.read(name)
+            except (OSError, ValueError):
+                return
+            try:
+                dead = self.read(DEAD)
+            except FileNotFoundError:
+                dead = {}
+            self.write(DEAD, {
+                metric.name: metric.merge([
+                    dead.get(metric.name, {}), exited.get(metric.name, {})])
+                for metric in self.registry
+                if metric.type != 'gauge'
+            })
+            os.remove(os.path.join(self.directory, name))
+
+    def flush(self):
+        '''Write the snapshot of this process'''
+        pid = os.getpid()
+        name = f'{pid}.json'
+        with self._flush_lock:
+            if pid != self._pid:
+                # A file under this PID was left by an exited process
+                self._pid = pid
+                self.archive(name)
+            self.write(name, {
+                metric.name: metric.snapshot() for metric in self.registry})
+
+    def start(self):
+        '''Start flushing from a daemon thread unless this process
+        already does'''
+        pid = os.getpid()
+        if pid == self._thread_pid:
+            return
+        self._thread_pid = pid
+        threading.Thread(
+            target=self.run, name='metrics-flush', daemon=True).start()
+
+    def run(self):
+        '''Flush every flush_interval seconds'''
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except OSError:
+                pass
+
+    def collect(self):
+        '''Return the merged snapshots of every process by metric name'''
+        self.flush()
+        snapshots = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json') or name == DEAD:
+                continue
+            if not is_alive(int(name[:-len('.json')])):
+                self.archive(name)
+                continue
+            try:
+                snapshots.append(self.read(name))
+            except (OSError, ValueError):
+                continue
+        try:
+            snapshots.append(self.read(DEAD))
+        except FileNotFoundError:
+            pass
+        return {
+            metric.name: metric.merge(
+                snapshot.get(metric.name, {}) for snapshot in snapshots)
+            for metric in self.registry
+        }
+
+    def render(self):
+        '''Return the metrics of every process in the Prometheus text
+        exposition format'''
+        return render(self.registry, self.collect())
@@ -0,0 +1,37 @@
+"""gist trigram search indexes
+
+Revision ID: 7b3d9f2c4a61
+Revises: e1f08c3b7d52
+Create Date: 2026-10-19 10:14:26.583190
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7b3d9f2c4a61'
+down_revision = 'e1f08c3b7d52'
+branch_labels = None
+depends_on = None
+
+INDEXES = (
+    ('ix_actors_lower_name_trgm', 'actors', 'name'),
+    ('ix_movies_lower_title_trgm', 'movies', 'title')
+)
+
+
+def upgrade():
+    # GiST serves the ILIKE filter and also returns matches nearest
+    # first for ORDER BY <->, so a search reads only limit rows
+    for name, table, column in INDEXES:
+        op.execute(f'DROP INDEX {name}')
+        op.execute(f'CREATE INDEX {name} ON {table} '
+                   f'USING gist (lower({column}) gist_trgm_ops)')
+
+
+def downgrade():
+    for name, table, column in INDEXES:
+        op.execute(f'DROP INDEX {name}')
+        op.execute(f'CREATE INDEX {name} ON {table} '
+                   f'USING gin (lower({column}) gin_trgm_ops)')
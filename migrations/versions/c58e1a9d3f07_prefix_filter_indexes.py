@@ -0,0 +1,31 @@
+"""prefix filter indexes
+
+Revision ID: c58e1a9d3f07
+Revises: 7b3d9f2c4a61
+Create Date: 2026-10-19 11:02:47.318264
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c58e1a9d3f07'
+down_revision = '7b3d9f2c4a61'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # The name and title filters match a prefix of lower(column) with
+    # LIKE, which a btree index serves only with text_pattern_ops unless
+    # the database collation is C
+    op.execute('CREATE INDEX ix_actors_lower_name_pattern ON actors '
+               '(lower(name) text_pattern_ops)')
+    op.execute('CREATE INDEX ix_movies_lower_title_pattern ON movies '
+               '(lower(title) text_pattern_ops)')
+
+
+def downgrade():
+    op.execute('DROP INDEX ix_movies_lower_title_pattern')
+    op.execute('DROP INDEX ix_actors_lower_name_pattern')
@@ -0,0 +1,27 @@
+"""unique lower movies title
+
+Revision ID: d7a3e8f1c620
+Revises: 8c41d5e2b9f3
+Create Date: 2026-10-18 11:26:54.302178
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd7a3e8f1c620'
+down_revision = '8c41d5e2b9f3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Case-insensitive uniqueness subsumes the plain UNIQUE(title)
+    op.create_index('ix_movies_lower_title', 'movies', [sa.text('lower(title)')], unique=True)
+    op.drop_constraint('movies_title_key', 'movies', type_='unique')
+
+
+def downgrade():
+    op.create_unique_constraint('movies_title_key', 'movies', ['title'])
+    op.drop_index('ix_movies_lower_title', table_name='movies')
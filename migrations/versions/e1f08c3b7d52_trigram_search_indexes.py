@@ -0,0 +1,30 @@
+"""trigram search indexes
+
+Revision ID: e1f08c3b7d52
+Revises: f4223dde7c3b
+Create Date: 2026-10-18 17:08:52.204611
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e1f08c3b7d52'
+down_revision = 'f4223dde7c3b'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    op.execute('CREATE INDEX ix_actors_lower_name_trgm ON actors '
+               'USING gin (lower(name) gin_trgm_ops)')
+    op.execute('CREATE INDEX ix_movies_lower_title_trgm ON movies '
+               'USING gin (lower(title) gin_trgm_ops)')
+
+
+def downgrade():
+    # pg_trgm stays installed; other database objects may rely on it
+    op.execute('DROP INDEX ix_movies_lower_title_trgm')
+    op.execute('DROP INDEX ix_actors_lower_name_trgm')
@@ -1,20 +1,191 @@
-import os
 import re
-from sqlalchemy import Column, DateTime, ForeignKey, Integer, String
+import sqlite3
+import time
+import weakref
+from sqlalchemy import (
+    BigInteger,
+    Column,
+    DateTime,
+    ForeignKey,
+    func,
+    Index,
+    Integer,
+    String
+)
+from sqlalchemy import case, delete, event, select, update
+from sqlalchemy.engine import Engine
 from sqlalchemy.orm import relationship
+from sqlalchemy.pool import QueuePool
+from flask import has_request_context, request
 from flask_sqlalchemy import SQLAlchemy
+from helpers import format_date, parse_date
+from metrics import Counter, Gauge, Histogram
 
-database_path = os.environ['DATABASE_URL']
-# SQLAlchemy 1.4.x workaround:
-# https://help.heroku.com/ZKNTJQSK/why-is-sqlalchemy-1-4-x-not-connecting-to-heroku-postgres
-if database_path.startswith("postgres://"):
-    database_path = database_path.replace("postgres://", "postgresql://", 1)
 db = SQLAlchemy()
 
+VERSIONED_TABLES = ('actors', 'movies', 'performances')
+POSTGRESQL_VERSION_TRIGGERS = [
+    '''CREATE OR REPLACE FUNCTION bump_table_version() RETURNS trigger AS $$
+    BEGIN
+        UPDATE table_versions SET version = version + 1
+        WHERE name = TG_TABLE_NAME;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql'''
+] + [
+    f'''CREATE TRIGGER {table}_version
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {table}
+    FOR EACH STATEMENT EXECUTE PROCEDURE bump_table_version()'''
+    for table in VERSIONED_TABLES
+]
+POSTGRESQL_SEARCH_INDEXES = [
+    'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+    'CREATE INDEX ix_actors_lower_name_trgm ON actors '
+    'USING gist (lower(name) gist_trgm_ops)',
+    'CREATE INDEX ix_movies_lower_title_trgm ON movies '
+    'USING gist (lower(title) gist_trgm_ops)'
+]
+SQLITE_VERSION_TRIGGERS = [
+    f'''CREATE TRIGGER {table}_{operation.lower()}_version
+    AFTER {operation} ON {table}
+    BEGIN
+        UPDATE table_versions SET version = version + 1
+        WHERE name = '{table}';
+    END'''
+    for table in VERSIONED_TABLES
+    for operation in ('INSERT', 'UPDATE', 'DELETE')
+]
 
-def setup_db(app, database_path=database_path):
+
+@event.listens_for(Engine, 'connect')
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    '''Enforce foreign keys (and ON DELETE CASCADE) on SQLite'''
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        dbapi_connection.execute('PRAGMA foreign_keys=ON')
+
+
+SQL_DURATION = Histogram(
+    'agency_sql_statement_duration_seconds',
+    'SQL statement latency by endpoint',
+    ('endpoint',),
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+             1, 2.5)
+)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_sql_timer(conn, cursor, statement, parameters, context,
+                    executemany):
+    if context is not None:
+        context.metrics_start = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def observe_sql_duration(conn, cursor, statement, parameters, context,
+                         executemany):
+    start = getattr(context, 'metrics_start', None)
+    if start is None:
+        return
+    endpoint = request.endpoint if has_request_context() else None
+    SQL_DURATION.observe(time.perf_counter() - start,
+                         endpoint=endpoint or 'none')
+
+
+POOLS = weakref.WeakSet()
+POOL_CHECKOUTS = Counter(
+    'agency_db_pool_checkouts_total',
+    'Connections checked out of the pool'
+)
+POOL_CHECKOUT_WAIT = Counter(
+    'agency_db_pool_checkout_wait_seconds_total',
+    'Seconds spent checking connections out of the pool'
+)
+POOL_WAITING = Gauge(
+    'agency_db_pool_waiting',
+    'Threads waiting to check a connection out of the pool'
+)
+
+
+def count_pool_connections():
+    '''Return the connections of every live pool by state'''
+    in_use = idle = 0
+    for pool in list(POOLS):
+        in_use += pool.checkedout()
+        idle += pool.checkedin()
+    return {('in_use',): in_use, ('idle',): idle}
+
+
+POOL_CONNECTIONS = Gauge(
+    'agency_db_pool_connections',
+    'Pooled connections by state',
+    ('state',),
+    callback=count_pool_connections
+)
+
+
+class InstrumentedQueuePool(QueuePool):
+    '''QueuePool that publishes checkout waits and connection counts'''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        POOLS.add(self)
+
+    def _do_get(self):
+        # Only a checkout finding no idle connection and no overflow left
+        # blocks until another thread checks one in
+        waiting = (self._pool.empty() and self._max_overflow > -1
+                   and self._overflow >= self._max_overflow)
+        if waiting:
+            POOL_WAITING.inc()
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            POOL_CHECKOUT_WAIT.inc(time.perf_counter() - start)
+            POOL_CHECKOUTS.inc()
+            if waiting:
+                POOL_WAITING.dec()
+
+
+def get_engine_options(config, database_path):
+    '''Return the SQLAlchemy engine options set by the DB_* config keys'''
+    if database_path.startswith('sqlite'):
+        # SQLite engines keep their own pool classes
+        return {}
+    options = {
+        'poolclass': InstrumentedQueuePool,
+        'pool_size': config['DB_POOL_SIZE'],
+        'max_overflow': config['DB_MAX_OVERFLOW'],
+        'pool_timeout': config['DB_POOL_TIMEOUT'],
+        'pool_recycle': config['DB_POOL_RECYCLE'],
+        'pool_pre_ping': config['DB_POOL_PRE_PING']
+    }
+    if config['DB_STATEMENT_TIMEOUT']:
+        options['connect_args'] = {
+            'options': f"-c statement_timeout={config['DB_STATEMENT_TIMEOUT']}"
+        }
+    return options
+
+
+def get_database_url(database_path):
+    '''Return database_path in a form SQLAlchemy accepts'''
+    # SQLAlchemy 1.4.x workaround:
+    # https://help.heroku.com/ZKNTJQSK/why-is-sqlalchemy-1-4-x-not-connecting-to-heroku-postgres
+    if database_path.startswith("postgres://"):
+        database_path = database_path.replace(
+            "postgres://", "postgresql://", 1)
+    return database_path
+
+
+def setup_db(app, database_path):
+    '''Bind db to app, connecting to database_path'''
+    if not database_path:
+        raise RuntimeError('DATABASE_URL is not set')
+    database_path = get_database_url(database_path)
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = get_engine_options(
+        app.config, database_path)
     db.app = app
     db.init_app(app)
 
@@ -36,6 +207,65 @@ class Base(db.Model):
     def update(self):
         db.session.commit()
 
+    @classmethod
+    def delete_by_id(cls, id):
+        '''Delete the row with id in a single statement and return whether
+        a row matched; dependent rows go through ON DELETE CASCADE'''
+        deleted = db.session.execute(
+            delete(cls).where(cls.id == id)
+        ).rowcount
+        db.session.commit()
+        return deleted > 0
+
+    @classmethod
+    def search(cls, column, text, limit):
+        '''Return up to limit rows whose column contains text, ignoring
+        case, best matches first
+
+        Text shorter than a trigram only matches at the start of column.
+        On Postgres rows rank by trigram distance, which the GiST indexes
+        return nearest first, so only limit matches are read however many
+        there are; elsewhere prefix matches and shorter values rank first.
+        '''
+        key = func.lower(column)
+        text = text.lower()
+        if len(text) < 3:
+            match = key.startswith(text, autoescape=True)
+        else:
+            match = key.contains(text, autoescape=True)
+        if db.engine.dialect.name == 'postgresql':
+            rank = (key.op('<->')(text),)
+        else:
+            rank = (
+                case((key.startswith(text, autoescape=True), 0), else_=1),
+                func.length(column)
+            )
+        return cls.query.filter(match).order_by(*rank, cls.id).limit(
+            limit).all()
+
+    @classmethod
+    def update_by_id(cls, id, values):
+        '''Update the row with id in a single statement and return it,
+        or None if no row matches'''
+        if not values:
+            return cls.query.get(id)
+        statement = update(cls).where(cls.id == id).values(values)
+        if not db.engine.dialect.full_returning:
+            if db.session.execute(statement).rowcount == 0:
+                return None
+            db.session.commit()
+            return cls.query.get(id)
+        instance = db.session.execute(
+            select(cls)
+            .from_statement(statement.returning(*cls.__table__.columns))
+            .execution_options(populate_existing=True)
+        ).scalar()
+        if instance is not None:
+            # Detach so the commit does not expire the returned values
+            db.session.expunge(instance)
+        db.session.commit()
+        return instance
+
 
 class Actor(Base):
     __tablename__ = 'actors'
@@ -43,48 +273,110 @@ class Actor(Base):
     name = Column(String(120), nullable=False)
     gender = Column(String(120), nullable=False)
     age = Column(Integer, nullable=False)
+    __table_args__ = (
+        Index('ix_actors_age_id', 'age', 'id'),
+        Index('ix_actors_gender_id', 'gender', 'id'),
+        Index('ix_actors_name_id', 'name', 'id'),
+        # Serves the case-insensitive name prefix filter on Postgres
+        Index(
+            'ix_actors_lower_name_pattern',
+            func.lower(name).label('lower_name'),
+            postgresql_ops={'lower_name': 'text_pattern_ops'}
+        ),
+    )
     movies = relationship(
-        "Performance", back_populates="actor", cascade='delete')
+        "Performance",
+        back_populates="actor",
+        cascade='delete',
+        passive_deletes=True
+    )
 
     def __init__(self, name, gender, age):
         self.name = name
         self.gender = gender
         self.age = age
 
-    def format(self):
-        return {
-            'id': self.id,
-            'name': self.name,
-            'gender': self.gender,
-            'age': self.age
-        }
+    FIELDS = ('id', 'name', 'gender', 'age')
+    SORTS = ('id', 'name', 'age')
+    FILTERS = {
+        'min_age': (int, lambda age: Actor.age >= age),
+        'max_age': (int, lambda age: Actor.age <= age),
+        'gender': (str, lambda gender: Actor.gender == gender),
+        'name': (str, lambda name: func.lower(Actor.name).startswith(
+            name.lower(), autoescape=True))
+    }
+
+    def format(self, fields=FIELDS):
+        return {field: getattr(self, field) for field in fields}
 
 
 class Movie(Base):
     __tablename__ = 'movies'
     id = Column(Integer, primary_key=True)
-    title = Column(String(120), unique=True, nullable=False)
+    title = Column(String(120), nullable=False)
     release_date = Column(DateTime, nullable=False)
+    __table_args__ = (
+        Index('ix_movies_lower_title', func.lower(title), unique=True),
+        Index('ix_movies_release_date_id', 'release_date', 'id'),
+        Index('ix_movies_title_id', 'title', 'id'),
+        # Serves the case-insensitive title prefix filter on Postgres
+        Index(
+            'ix_movies_lower_title_pattern',
+            func.lower(title).label('lower_title'),
+            postgresql_ops={'lower_title': 'text_pattern_ops'}
+        ),
+    )
     actors = relationship(
-        "Performance", back_populates="movie", cascade='delete')
+        "Performance",
+        back_populates="movie",
+        cascade='delete',
+        passive_deletes=True
+    )
 
     def __init__(self, title, release_date):
         self.title = title
         self.release_date = release_date
 
-    def format(self):
-        return {
-            'id': self.id,
-            'title': self.title,
-            'release_date': self.release_date
-        }
+    FIELDS = ('id', 'title', 'release_date')
+    SORTS = ('id', 'title', 'release_date')
+    FILTERS = {
+        'min_release_date': (
+            parse_date, lambda date: Movie.release_date >= date),
+        'max_release_date': (
+            parse_date, lambda date: Movie.release_date <= date),
+        'title': (str, lambda title: func.lower(Movie.title).startswith(
+            title.lower(), autoescape=True))
+    }
+
+    def format(self, fields=FIELDS):
+        movie = {field: getattr(self, field) for field in fields}
+        if 'release_date' in movie:
+            movie['release_date'] = format_date(movie['release_date'])
+        return movie
 
 
 class Performance(Base):
     __tablename__ = 'performances'
+    __table_args__ = (
+        Index(
+            'ix_performances_actor_id_movie_id',
+            'actor_id',
+            'movie_id',
+            unique=True
+        ),
+    )
     id = Column(Integer, primary_key=True)
-    actor_id = Column(Integer, ForeignKey('actors.id'), nullable=False)
-    movie_id = Column(Integer, ForeignKey('movies.id'), nullable=False)
+    actor_id = Column(
+        Integer,
+        ForeignKey('actors.id', ondelete='CASCADE'),
+        nullable=False
+    )
+    movie_id = Column(
+        Integer,
+        ForeignKey('movies.id', ondelete='CASCADE'),
+        nullable=False,
+        index=True
+    )
     actor = relationship("Actor", back_populates="movies")
     movie = relationship("Movie", back_populates="actors")
 
@@ -92,9 +384,61 @@ class Performance(Base):
         self.actor_id = actor_id
         self.movie_id = movie_id
 
-    def format(self):
-        return {
-            'id': self.id,
-            'actor_id': self.actor_id,
-            'movie_id': self.movie_id
-        }
+    FIELDS = ('id', 'actor_id', 'movie_id')
+
+    def format(self, expand=(), fields=FIELDS):
+        performance = {field: getattr(self, field) for field in fields}
+        for name in expand:
+            performance[name] = getattr(self, name).format()
+        return performance
+
+
+class TableVersion(db.Model):
+    '''Write counter of a table, bumped by a trigger in the same
+    transaction as every statement that changes the table
+
+    The bump holds the row lock of the table's counter until commit, so
+    transactions writing the same table are serialized. Keep them short.
+    '''
+    __tablename__ = 'table_versions'
+    name = Column(String(120), primary_key=True)
+    version = Column(BigInteger, nullable=False)
+
+    @classmethod
+    def get_versions(cls, names):
+        '''Return the version of each of names in one query'''
+        versions = dict(
+            db.session.query(cls.name, cls.version).filter(
+                cls.name.in_(names))
+        )
+        return [versions.get(name, 0) for name in names]
+
+
+@event.listens_for(db.Model.metadata, 'after_create')
+def create_version_triggers(metadata, connection, tables=(), **kw):
+    '''Seed table_versions and install its triggers when create_all
+    creates it; migrations do the same on existing databases'''
+    if TableVersion.__table__ not in tables:
+        return
+    connection.execute(
+        TableVersion.__table__.insert(),
+        [{'name': table, 'version': 0} for table in VERSIONED_TABLES]
+    )
+    if connection.dialect.name == 'postgresql':
+        statements = POSTGRESQL_VERSION_TRIGGERS
+    else:
+        statements = SQLITE_VERSION_TRIGGERS
+    for statement in statements:
+        connection.exec_driver_sql(statement)
+
+
+@event.listens_for(db.Model.metadata, 'after_create')
+def create_search_indexes(metadata, connection, tables=(), **kw):
+    '''Install the trigram search indexes on Postgres when create_all
+    creates the tables they cover'''
+    if connection.dialect.name != 'postgresql':
+        return
+    if Actor.__table__ not in tables or Movie.__table__ not in tables:
+        return
+    for statement in POSTGRESQL_SEARCH_INDEXES:
+        connection.exec_driver_sql(statement)
@@ -0,0 +1,120 @@
+import cProfile
+import json
+import logging
+import os
+import random
+import time
+import uuid
+from contextlib import contextmanager
+from flask import g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger('agency.profile')
+
+
+def get_timings():
+    '''Return the phase timings of the current request, or None when the
+    request is not instrumented'''
+    if not has_app_context():
+        return None
+    return g.get('profile_timings')
+
+
+@contextmanager
+def timed(phase):
+    '''Add the time spent in the block to phase of the current request'''
+    timings = get_timings()
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[phase] = timings.get(phase, 0) + time.perf_counter() - start
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_statement_timer(conn, cursor, statement, parameters, context,
+                          executemany):
+    if context is not None and get_timings() is not None:
+        context.profile_start = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def stop_statement_timer(conn, cursor, statement, parameters, context,
+                         executemany):
+    start = getattr(context, 'profile_start', None)
+    if start is None:
+        return
+    timings = get_timings()
+    if timings is not None:
+        timings['sql'] = timings.get('sql', 0) + time.perf_counter() - start
+        g.profile_statements += 1
+
+
+def format_server_timing(timings, statements):
+    '''Format phase timings in seconds as a Server-Timing header value'''
+    metrics = []
+    for phase, seconds in timings.items():
+        metric = f'{phase};dur={seconds * 1000:.2f}'
+        if phase == 'sql':
+            metric += f';desc="{statements} statements"'
+        metrics.append(metric)
+    return ', '.join(metrics)
+
+
+def init_profiling(app):
+    '''Time request phases when PROFILE is set and capture a cProfile
+    dump for a PROFILE_SAMPLE_RATE fraction of requests'''
+    sample_rate = app.config['PROFILE_SAMPLE_RATE']
+    if not app.config['PROFILE'] and not sample_rate:
+        return
+    if not logger.handlers:
+        logger.addHandler(logging.StreamHandler())
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+
+    @app.before_request
+    def start_profile():
+        '''Start timing the request and, when sampled, profiling it'''
+        g.profile_start = time.perf_counter()
+        if app.config['PROFILE']:
+            g.profile_timings = {}
+            g.profile_statements = 0
+        if sample_rate and random.random() < sample_rate:
+            g.profiler = cProfile.Profile()
+            g.profiler.enable()
+
+    @app.after_request
+    def finish_profile(response):
+        '''Report the request timings and save a sampled profile'''
+        profiler = g.pop('profiler', None)
+        if profiler is not None:
+            profiler.disable()
+            directory = app.config['PROFILE_DIR']
+            os.makedirs(directory, exist_ok=True)
+            profiler.dump_stats(os.path.join(
+                directory,
+                f'{time.time():.0f}-{request.endpoint}-{uuid.uuid4().hex}'
+                '.prof'
+            ))
+        timings = g.pop('profile_timings', None)
+        if timings is None:
+            return response
+        timings['total'] = time.perf_counter() - g.profile_start
+        response.headers['Server-Timing'] = format_server_timing(
+            timings, g.profile_statements)
+        logger.info(json.dumps({
+            'method': request.method,
+            'path': request.path,
+            'endpoint': request.endpoint,
+            'status': response.status_code,
+            'statements': g.profile_statements,
+            'timings_ms': {
+                phase: round(seconds * 1000, 3)
+                for phase, seconds in timings.items()
+            }
+        }))
+        return response
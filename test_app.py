@@ -1,30 +1,172 @@
 import json
 import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
 import unittest
-from app import create_app
-from flask_sqlalchemy import SQLAlchemy
-from models import Actor, Movie, Performance, setup_db
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from app import create_app, warm_up
+from benchmarks.idp import LocalIdP
+from models import (
+    Actor,
+    db,
+    InstrumentedQueuePool,
+    Movie,
+    Performance,
+    POOL_CONNECTIONS,
+    POOL_WAITING
+)
+from sqlalchemy import create_engine, event, func, text
+from sqlalchemy.exc import OperationalError
+from werkzeug.test import EnvironBuilder, run_wsgi_app
 
-CASTING_ASSISTANT = os.environ.get('CASTING_ASSISTANT')
-CASTING_DIRECTOR = os.environ.get('CASTING_DIRECTOR')
-EXECUTIVE_PRODUCER = os.environ.get('EXECUTIVE_PRODUCER')
+# Sign tokens locally, with auth pointed at this identity provider
+IDP = LocalIdP()
+JWKS_URL = IDP.write_jwks(os.path.join(tempfile.mkdtemp(), 'jwks.json'))
+
+# In memory by default; never DATABASE_URL, which may be production
+TEST_DATABASE_URL = os.environ.get('TEST_DATABASE_URL', 'sqlite://')
+TEST_CONFIG = dict(IDP.environment(JWKS_URL), DATABASE_URL=TEST_DATABASE_URL)
+
+CASTING_ASSISTANT = IDP.issue_role('casting-assistant')
+CASTING_DIRECTOR = IDP.issue_role('casting-director')
+EXECUTIVE_PRODUCER = IDP.issue_role('executive-producer')
+
+
+def enable_sqlite_savepoints(engine):
+    """Let pysqlite run SAVEPOINTs by emitting BEGIN itself"""
+    @event.listens_for(engine, 'connect')
+    def disable_pysqlite_transactions(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, 'begin')
+    def begin(connection):
+        connection.exec_driver_sql('BEGIN')
 
 
 class AgencyTestCase(unittest.TestCase):
-    """Agency test case"""
+    """Agency test case
+
+    The schema is created once. Each test runs in a transaction that is
+    rolled back afterwards, so tests see no other test's rows and can run
+    in any order, or in parallel with the in-memory database.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        """Run once before the tests"""
+        cls.app = create_app(TEST_CONFIG)
+        with cls.app.app_context():
+            if db.engine.dialect.name == 'sqlite':
+                enable_sqlite_savepoints(db.engine)
+            db.create_all()
 
     def setUp(self):
         """Run before each test"""
-        self.app = create_app()
         self.client = self.app.test_client
-        setup_db(self.app)
-        with self.app.app_context():
-            self.db = SQLAlchemy()
-            self.db.init_app(self.app)
+        context = self.app.app_context()
+        context.push()
+        self.addCleanup(context.pop)
+        connection = self.connection = db.engine.connect()
+        self.addCleanup(connection.close)
+        transaction = connection.begin()
+        self.addCleanup(transaction.rollback)
+        # Commits by the app release a savepoint and rollbacks return to
+        # one; either way a new savepoint is started
+        session = db.session
+        db.session = db.create_scoped_session(
+            {'bind': connection, 'binds': {}})
+        self.addCleanup(setattr, db, 'session', session)
+        self.addCleanup(db.session.remove)
+        db.session.begin_nested()
+
+        @event.listens_for(db.session, 'after_transaction_end')
+        def restart_savepoint(session, transaction):
+            if transaction.nested and not transaction._parent.nested:
+                session.expire_all()
+                session.begin_nested()
+
+    @contextmanager
+    def record_statements(self):
+        """Record the SQL statements run in the block, leaving out the
+        savepoints of the test transaction"""
+        statements = []
+
+        def record_statement(conn, cursor, statement, *args):
+            if 'SAVEPOINT' not in statement:
+                statements.append(statement)
+
+        engine = self.connection.engine
+        event.listen(engine, 'before_cursor_execute', record_statement)
+        try:
+            yield statements
+        finally:
+            event.remove(engine, 'before_cursor_execute', record_statement)
+
+    @contextmanager
+    def explain_last_select(self):
+        """Append the Postgres plan of the last SELECT run in the block to
+        the yielded list"""
+        selects = []
+
+        def record_select(conn, cursor, statement, parameters, *args):
+            if statement.startswith('SELECT'):
+                selects.append((statement, parameters))
+
+        plans = []
+        engine = self.connection.engine
+        event.listen(engine, 'before_cursor_execute', record_select)
+        try:
+            yield plans
+        finally:
+            event.remove(engine, 'before_cursor_execute', record_select)
+        # The tables are tiny, so make the planner use the index it would
+        # pick for a large one
+        self.connection.exec_driver_sql('SET LOCAL enable_seqscan = off')
+        statement, parameters = selects[-1]
+        plans.append('\n'.join(
+            row[0] for row in self.connection.exec_driver_sql(
+                'EXPLAIN ' + statement, parameters)))
 
-    def tearDown(self):
-        """Run after each test"""
-        pass
+    def create_client(self, **config):
+        """Return a test client of an app with config that shares this
+        test's transaction"""
+        app = create_app(dict(TEST_CONFIG, **config))
+        context = app.app_context()
+        context.push()
+        self.addCleanup(context.pop)
+        return app.test_client()
+
+    def create_actor(self, **values):
+        """Insert an actor and return it"""
+        actor = Actor(**dict(
+            {'name': 'Margot Robbie', 'gender': 'female', 'age': 30},
+            **values))
+        actor.insert()
+        return actor
+
+    def create_movie(self, **values):
+        """Insert a movie with a unique title and return it"""
+        movie = Movie(**dict({
+            'title': 'Barbie ' + uuid.uuid4().hex,
+            'release_date': datetime(2030, 1, 1)
+        }, **values))
+        movie.insert()
+        return movie
+
+    def create_performance(self):
+        """Insert a performance of a new actor in a new movie and return
+        it"""
+        performance = Performance(
+            actor_id=self.create_actor().id,
+            movie_id=self.create_movie().id
+        )
+        performance.insert()
+        return performance
 
     def test_001_success_get_actors(self):
         """Test success GET /actors"""
@@ -63,9 +205,9 @@ class AgencyTestCase(unittest.TestCase):
 
     def test_004_success_get_actors_by_id(self):
         """Test success GET /actors/:actor_id"""
-        last_actor = Actor.query.order_by(Actor.id.desc()).first()
+        actor = self.create_actor()
         response = self.client().get(
-            '/actors/' + str(last_actor.id),
+            '/actors/' + str(actor.id),
             headers={'Authorization': 'Bearer ' + CASTING_ASSISTANT}
         )
         data = json.loads(response.data)
@@ -88,9 +230,9 @@ class AgencyTestCase(unittest.TestCase):
             'gender': 'male',
             'age': '57'
         }
-        last_actor = Actor.query.order_by(Actor.id.desc()).first()
+        actor_id = self.create_actor().id
         response = self.client().patch(
-            '/actors/' + str(last_actor.id),
+            '/actors/' + str(actor_id),
             json=actor,
             headers={'Authorization': 'Bearer ' + CASTING_DIRECTOR}
         )
@@ -115,9 +257,9 @@ class AgencyTestCase(unittest.TestCase):
 
     def test_008_error_patch_actors_body_not_valid_structure(self):
         """Test error PATCH /actors when body not valid structure"""
-        last_actor = Actor.query.order_by(Actor.id.desc()).first()
+        actor_id = self.create_actor().id
         response = self.client().patch(
-            '/actors/' + str(last_actor.id),
+            '/actors/' + str(actor_id),
             json=None,
             headers={'Authorization': 'Bearer ' + CASTING_DIRECTOR}
         )
@@ -138,7 +280,7 @@ class AgencyTestCase(unittest.TestCase):
         """Test success POST /movies"""
         movie = {
             'title': 'Bullet Train',
-            'release_date': '2022-09-23T00:00:00.000Z'
+            'release_date': '2099-09-23T00:00:00.000Z'
         }
         response = self.client().post(
             '/movies',
@@ -161,9 +303,10 @@ class AgencyTestCase(unittest.TestCase):
 
     def test_012_error_post_movies_title_already_exists(self):
         """Test error POST /movies when title already exists"""
+        self.create_movie(title='Bullet Train')
         movie = {
             'title': 'Bullet Train',
-            'release_date': '2022-09-23T00:00:00.000Z'
+            'release_date': '2099-09-23T00:00:00.000Z'
         }
         response = self.client().post(
             '/movies',
@@ -178,7 +321,7 @@ class AgencyTestCase(unittest.TestCase):
         """Test error POST /movies when release date format not valid"""
         movie = {
             'title': 'Untitled Movie',
-            'release_date': '2022-09-23'
+            'release_date': '2099-09-23'
         }
         response = self.client().post(
             '/movies',
@@ -206,9 +349,9 @@ class AgencyTestCase(unittest.TestCase):
 
     def test_015_success_get_movies_by_id(self):
         """Test success GET /movies/:movie_id"""
-        last_movie = Movie.query.order_by(Movie.id.desc()).first()
+        movie = self.create_movie()
         response = self.client().get(
-            '/movies/' + str(last_movie.id),
+            '/movies/' + str(movie.id),
             headers={'Authorization': 'Bearer ' + CASTING_ASSISTANT}
         )
         data = json.loads(response.data)
@@ -228,11 +371,11 @@ class AgencyTestCase(unittest.TestCase):
         """Test success PATCH /movies"""
         movie = {
             'title': 'Bullet Train',
-            'release_date': '2022-09-30T00:00:00.000Z'
+            'release_date': '2099-09-30T00:00:00.000Z'
         }
-        last_movie = Movie.query.order_by(Movie.id.desc()).first()
+        movie_id = self.create_movie().id
         response = self.client().patch(
-            '/movies/' + str(last_movie.id),
+            '/movies/' + str(movie_id),
             json=movie,
             headers={'Authorization': 'Bearer ' + EXECUTIVE_PRODUCER}
         )
@@ -243,7 +386,7 @@ class AgencyTestCase(unittest.TestCase):
         """Test error PATCH /movies/:movie_id when id not exist"""
         movie = {
             'title': 'Blonde',
-            'release_date': '2022-09-30T00:00:00.000Z'
+            'release_date': '2099-09-30T00:00:00.000Z'
         }
         response = self.client().patch(
             '/movies/999',
@@ -256,9 +399,9 @@ class AgencyTestCase(unittest.TestCase):
 
     def test_019_error_patch_movies_body_not_valid_structure(self):
         """Test error PATCH /movies when body not valid structure"""
-        last_movie = Movie.query.order_by(Movie.id.desc()).first()
+        movie_id = self.create_movie().id
         response = self.client().patch(
-            '/movies/' + str(last_movie.id),
+            '/movies/' + str(movie_id),
             json=None,
             headers={'Authorization': 'Bearer ' + EXECUTIVE_PRODUCER}
         )
@@ -268,15 +411,11 @@ class AgencyTestCase(unittest.TestCase):
 
     def test_020_error_patch_movies_title_already_exists(self):
         """Test error PATCH /movies when title already exists"""
-        movie = Movie(
-            title='Blonde',
-            release_date='2022-09-30T00:00:00.000Z'
-        )
-        movie.insert()
-        movie_id = movie.id
+        self.create_movie(title='Bullet Train')
+        movie_id = self.create_movie(title='Blonde').id
         movie = {
             'title': 'Bullet Train',
-            'release_date': '2022-09-30T00:00:00.000Z'
+            'release_date': '2099-09-30T00:00:00.000Z'
         }
         response = self.client().patch(
             '/movies/' + str(movie_id),
@@ -286,14 +425,12 @@ class AgencyTestCase(unittest.TestCase):
         data = json.loads(response.data)
         self.assertEqual(response.status_code, 422)
         self.assertEqual(data['message'], 'Unprocessable Entity')
-        movie = Movie.query.order_by(Movie.id.desc()).first()
-        movie.delete()
 
     def test_021_error_post_movies_release_date_format_not_valid(self):
         """Test error POST /movies when release date format not valid"""
         movie = {
             'title': 'Untitled Movie',
-            'release_date': '2022-09-23'
+            'release_date': '2099-09-23'
         }
         response = self.client().post(
             '/movies',
@@ -330,11 +467,9 @@ class AgencyTestCase(unittest.TestCase):
 
     def test_024_success_post_performances(self):
         """Test success POST /performances"""
-        last_actor = Actor.query.order_by(Actor.id.desc()).first()
-        last_movie = Movie.query.order_by(Movie.id.desc()).first()
         performance = {
-            'actor_id': last_actor.id,
-            'movie_id': last_movie.id
+            'actor_id': self.create_actor().id,
+            'movie_id': self.create_movie().id
         }
         response = self.client().post(
             '/performances',
@@ -357,10 +492,9 @@ class AgencyTestCase(unittest.TestCase):
 
     def test_026_success_delete_performances_by_id(self):
         """Test success DELETE /performances/:performance_id"""
-        last_performance = Performance.query.order_by(
-            Performance.id.desc()).first()
+        performance_id = self.create_performance().id
         response = self.client().delete(
-            '/performances/' + str(last_performance.id),
+            '/performances/' + str(performance_id),
             headers={'Authorization': 'Bearer ' + CASTING_DIRECTOR}
         )
         data = json.loads(response.data)
@@ -378,9 +512,9 @@ class AgencyTestCase(unittest.TestCase):
 
     def test_028_success_delete_actors_by_id(self):
         """Test success DELETE /actors/:actor_id"""
-        last_actor = Actor.query.order_by(Actor.id.desc()).first()
+        actor_id = self.create_actor().id
         response = self.client().delete(
-            '/actors/' + str(last_actor.id),
+            '/actors/' + str(actor_id),
             headers={'Authorization': 'Bearer ' + CASTING_DIRECTOR}
         )
         data = json.loads(response.data)
@@ -398,9 +532,9 @@ class AgencyTestCase(unittest.TestCase):
 
     def test_030_success_delete_movies_by_id(self):
         """Test success DELETE /movies/:movie_id"""
-        last_movie = Movie.query.order_by(Movie.id.desc()).first()
+        movie_id = self.create_movie().id
         response = self.client().delete(
-            '/movies/' + str(last_movie.id),
+            '/movies/' + str(movie_id),
             headers={'Authorization': 'Bearer ' + EXECUTIVE_PRODUCER}
         )
         data = json.loads(response.data)
@@ -416,5 +550,713 @@ class AgencyTestCase(unittest.TestCase):
         self.assertEqual(response.status_code, 404)
         self.assertEqual(data['message'], 'Not Found')
 
+    def test_032_success_get_actors_paginated(self):
+        """Test success GET /actors with limit and cursor"""
+        for name in ('Margot Robbie', 'Tom Hanks'):
+            self.create_actor(name=name, gender='unknown', age=40)
+        response = self.client().get(
+            '/actors?limit=1',
+            headers={'Authorization': 'Bearer ' + CASTING_ASSISTANT}
+        )
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(data['actors']), 1)
+        self.assertIsNotNone(data['next_cursor'])
+        response = self.client().get(
+            '/actors?limit=1&cursor=' + data['next_cursor'],
+            headers={'Authorization': 'Bearer ' + CASTING_ASSISTANT}
+        )
+        next_page = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertGreater(
+            next_page['actors'][0]['id'], data['actors'][0]['id'])
+
+    def test_033_error_get_actors_limit_above_maximum(self):
+        """Test error GET /actors when limit above maximum page size"""
+        response = self.client().get(
+            '/actors?limit=' + str(self.app.config['MAX_PAGE_SIZE'] + 1),
+            headers={'Authorization': 'Bearer ' + CASTING_ASSISTANT}
+        )
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(data['message'], 'Bad Request')
+
+    def test_034_error_get_performances_cursor_not_valid(self):
+        """Test error GET /performances when cursor not valid"""
+        response = self.client().get(
+            '/performances?cursor=not-a-cursor',
+            headers={'Authorization': 'Bearer ' + CASTING_ASSISTANT}
+        )
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(data['message'], 'Bad Request')
+
+    def test_035_success_get_actors_stream(self):
+        """Test success GET /actors streamed as NDJSON"""
+        self.create_actor()
+        response = self.client().get(
+            '/actors?stream=1',
+            headers={'Authorization': 'Bearer ' + CASTING_ASSISTANT}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        actors = [json.loads(line) for line in response.data.splitlines()]
+        self.assertEqual(len(actors), Actor.query.count())
+
+    def test_036_success_get_movies_accept_ndjson(self):
+        """Test success GET /movies with Accept: application/x-ndjson"""
+        response = self.client().get(
+            '/movies',
+            headers={
+                'Authorization': 'Bearer ' + CASTING_ASSISTANT,
+                'Accept': 'application/x-ndjson'
+            }
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+
+    def test_037_success_get_performances_expand_single_statement(self):
+        """Test GET /performances?expand=actor,movie runs one statement"""
+        actor = self.create_actor()
+        for title in ('Babylon', 'Barbie'):
+            movie = self.create_movie(title=title + ' ' + uuid.uuid4().hex)
+            Performance(actor_id=actor.id, movie_id=movie.id).insert()
+        with self.record_statements() as statements:
+            response = self.client().get(
+                '/performances?expand=actor,movie&limit=100',
+                headers={'Authorization': 'Bearer ' + CASTING_ASSISTANT}
+            )
+        statements = [statement for statement in statements
+                      if 'table_versions' not in statement]
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(statements), 1)
+        for performance in data['performances']:
+            self.assertEqual(
+                performance['actor']['id'], performance['actor_id'])
+            self.assertEqual(
+                performance['movie']['id'], performance['movie_id'])
+
+    def test_038_error_get_performances_expand_not_valid(self):
+        """Test error GET /performances when expand not valid"""
+        response = self.client().get(
+            '/performances?expand=director',
+            headers={'Authorization': 'Bearer ' + CASTING_ASSISTANT}
+        )
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(data['message'], 'Bad Request')
+
+    def test_039_success_get_actors_movies(self):
+        """Test success GET /actors/:actor_id/movies"""
+        actor = self.create_actor()
+        movie = self.create_movie()
+        Performance(actor_id=actor.id, movie_id=movie.id).insert()
+        response = self.client().get(
+            '/actors/' + str(actor.id) + '/movies',
+            headers={'Authorization': 'Bearer ' + CASTING_ASSISTANT}
+        )
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([m['id'] for m in data['movies']], [movie.id])
+        response = self.client().get(
+            '/movies/' + str(movie.id) + '/actors',
+            headers={'Authorization': 'Bearer ' + CASTING_ASSISTANT}
+        )
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([a['id'] for a in data['actors']], [actor.id])
+
+    def test_040_error_get_actors_movies_not_exist(self):
+        """Test error GET /actors/:actor_id/movies when id not exist"""
+        response = self.client().get(
+            '/actors/999/movies',
+            headers={'Authorization': 'Bearer ' + CASTING_ASSISTANT}
+        )
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(data['message'], 'Not Found')
+
+    def test_041_error_get_movies_actors_not_exist(self):
+        """Test error GET /movies/:movie_id/actors when id not exist"""
+        response = self.client().get(
+            '/movies/999/actors',
+            headers={'Authorization': 'Bearer ' + CASTING_ASSISTANT}
+        )
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(data['message'], 'Not Found')
+
+    def test_042_error_post_performances_already_exists(self):
+        """Test error POST /performances when performance already exists"""
+        actor = self.create_actor()
+        movie = self.create_movie()
+        performance = {
+            'actor_id': actor.id,
+            'movie_id': movie.id
+        }
+        for status_code in (200, 422):
+            response = self.client().post(
+                '/performances',
+                json=performance,
+                headers={'Authorization': 'Bearer ' + CASTING_DIRECTOR}
+            )
+            self.assertEqual(response.status_code, status_code)
+
+    def test_043_error_post_performances_actor_not_exist(self):
+        """Test error POST /performances when actor not exist"""
+        movie = self.create_movie()
+        performance = {
+            'actor_id': 999999,
+            'movie_id': movie.id
+        }
+        response = self.client().post(
+            '/performances',
+            json=performance,
+            headers={'Authorization': 'Bearer ' + CASTING_DIRECTOR}
+        )
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(data['message'], 'Unprocessable Entity')
+
+    def test_044_error_post_movies_title_exists_different_case(self):
+        """Test error POST /movies when title exists in a different case"""
+        title = 'Barbie ' + uuid.uuid4().hex
+        self.create_movie(title=title)
+        response = self.client().post(
+            '/movies',
+            json={
+                'title': title.upper(),
+                'release_date': '2099-01-01T00:00:00.000Z'
+            },
+            headers={'Authorization': 'Bearer ' + EXECUTIVE_PRODUCER}
+        )
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(data['message'], 'Unprocessable Entity')
+
+    def test_045_success_post_actors_bulk(self):
+        """Test success POST /actors/bulk"""
+        actors = [
+            {'name': 'Margot Robbie', 'gender': 'female', 'age': 30},
+            {'name': 'Ryan Gosling', 'gender': 'male', 'age': '40'}
+        ]
+        response = self.client().post(
+            '/actors/bulk',
+            json=actors,
+            headers={'Authorization': 'Bearer ' + CASTING_DIRECTOR}
+        )
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(data['success'])
+        self.assertEqual(
+            [result['actor']['age'] for result in data['results']], [30, 40])
+
+    def test_046_error_post_actors_bulk_item_not_valid(self):
+        """Test error POST /actors/bulk when an item not valid"""
+        count = Actor.query.count()
+        actors = [
+            {'name': 'Margot Robbie', 'gender': 'female', 'age': 30},
+            {'name': 'Ryan Gosling', 'gender': 'male', 'age': 120}
+        ]
+        response = self.client().post(
+            '/actors/bulk',
+            json=actors,
+            headers={'Authorization': 'Bearer ' + CASTING_DIRECTOR}
+        )
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(data['message'], 'Unprocessable Entity')
+        self.assertEqual(data['results'][1]['error'], 422)
+        self.assertEqual(Actor.query.count(), count)
+
+    def test_047_success_post_performances_bulk_partial(self):
+        """Test success POST /performances/bulk?atomic=false"""
+        actor = self.create_actor()
+        movie = self.create_movie()
+        performances = [
+            {'actor_id': actor.id, 'movie_id': movie.id},
+            {'actor_id': actor.id, 'movie_id': movie.id},
+            {'actor_id': 999999, 'movie_id': movie.id}
+        ]
+        response = self.client().post(
+            '/performances/bulk?atomic=false',
+            json=performances,
+            headers={'Authorization': 'Bearer ' + CASTING_DIRECTOR}
+        )
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(data['success'])
+        self.assertEqual(
+            [result['success'] for result in data['results']],
+            [True, False, False]
+        )
+
+    def test_048_success_patch_actors_single_statement(self):
+        """Test PATCH /actors/:actor_id runs one UPDATE ... RETURNING"""
+        actor_id = self.create_actor().id
+        with self.record_statements() as statements:
+            response = self.client().patch(
+                '/actors/' + str(actor_id),
+                json={'age': '31'},
+                headers={'Authorization': 'Bearer ' + CASTING_DIRECTOR}
+            )
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['actor']['age'], 31)
+        # Without RETURNING the row is read back after the UPDATE
+        self.assertEqual(
+            len(statements), 1 if db.engine.dialect.full_returning else 2)
+
+    def test_049_success_delete_actors_cascades_performances(self):
+        """Test DELETE /actors/:actor_id cascades to performances"""
+        actor = self.create_actor()
+        movie = self.create_movie()
+        actor_id, movie_id = actor.id, movie.id
+        Performance(actor_id=actor_id, movie_id=movie_id).insert()
+        with self.record_statements() as statements:
+            response = self.client().delete(
+                '/actors/' + str(actor_id),
+                headers={'Authorization': 'Bearer ' + CASTING_DIRECTOR}
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(statements), 1)
+        self.assertEqual(
+            Performance.query.filter_by(actor_id=actor_id).count(), 0)
+
+    def test_050_success_get_actors_by_id_cached(self):
+        """Test GET /actors/:actor_id is cached until the actor changes"""
+        client = self.create_client(CACHE_TYPE='local')
+        headers = {'Authorization': 'Bearer ' + CASTING_DIRECTOR}
+        response = client.post(
+            '/actors',
+            json={'name': 'Margot Robbie', 'gender': 'female', 'age': 30},
+            headers=headers
+        )
+        path = '/actors/' + str(json.loads(response.data)['actor']['id'])
+        self.assertEqual(client.get(path, headers=headers)
+                         .headers['X-Cache'], 'MISS')
+        with self.record_statements() as statements:
+            response = client.get(path, headers=headers)
+        self.assertEqual(response.headers['X-Cache'], 'HIT')
+        self.assertEqual(len(statements), 1)
+        client.patch(path, json={'age': 31}, headers=headers)
+        response = client.get(path, headers=headers)
+        data = json.loads(response.data)
+        self.assertEqual(response.headers['X-Cache'], 'MISS')
+        self.assertEqual(data['actor']['age'], 31)
+
+    def test_051_success_get_movies_by_id_not_modified(self):
+        """Test GET /movies/:movie_id answers If-None-Match with one query"""
+        client = self.create_client(CACHE_TYPE='local')
+        movie = self.create_movie()
+        path = '/movies/' + str(movie.id)
+        headers = {'Authorization': 'Bearer ' + EXECUTIVE_PRODUCER}
+        etag = client.get(path, headers=headers).headers['ETag']
+        with self.record_statements() as statements:
+            response = client.get(
+                path, headers=dict(headers, **{'If-None-Match': etag}))
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers['ETag'], etag)
+        self.assertTrue(etag.startswith('W/'))
+        self.assertEqual(len(statements), 1)
+        # The test client adds a default Content-Type, so read the headers
+        # the app sends
+        status, sent = run_wsgi_app(client.application, EnvironBuilder(
+            path, headers=dict(headers, **{'If-None-Match': etag})
+        ).get_environ())[1:]
+        self.assertNotIn('Content-Type', sent)
+        client.patch(
+            path, json={'title': 'Oppenheimer ' + uuid.uuid4().hex},
+            headers=headers)
+        response = client.get(
+            path, headers=dict(headers, **{'If-None-Match': etag}))
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_052_success_get_actors_fields(self):
+        """Test GET /actors?fields= selects only the requested columns"""
+        with self.record_statements() as statements:
+            response = self.client().get(
+                '/actors?fields=name',
+                headers={'Authorization': 'Bearer ' + CASTING_ASSISTANT}
+            )
+        statements = [statement for statement in statements
+                      if 'FROM actors' in statement]
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        for actor in data['actors']:
+            self.assertEqual(list(actor), ['name'])
+        self.assertNotIn('actors.age', statements[0])
+
+    def test_053_error_get_actors_fields_not_allowed(self):
+        """Test error GET /actors when a field is not allowed"""
+        response = self.client().get(
+            '/actors?fields=name,salary',
+            headers={'Authorization': 'Bearer ' + CASTING_ASSISTANT}
+        )
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(data['message'], 'Bad Request')
+
+    def test_054_success_get_actors_filter_sort(self):
+        """Test GET /actors filters and pages in the requested order"""
+        prefix = uuid.uuid4().hex
+        for age in (31, 32, 33):
+            self.create_actor(name=prefix + ' ' + str(age), age=age)
+        path = '/actors?limit=1&sort=-age&min_age=32&name=' + prefix.upper()
+        headers = {'Authorization': 'Bearer ' + CASTING_ASSISTANT}
+        ages = []
+        while path:
+            data = json.loads(self.client().get(path, headers=headers).data)
+            ages += [actor['age'] for actor in data['actors']]
+            path = data['next_cursor'] and (
+                '/actors?limit=1&sort=-age&min_age=32&name=' + prefix +
+                '&cursor=' + data['next_cursor'])
+        self.assertEqual(ages, [33, 32])
+
+    def test_055_success_get_movies_filter_release_date(self):
+        """Test GET /movies filters by release date range"""
+        title = uuid.uuid4().hex
+        for month in (1, 4, 7):
+            self.create_movie(title=title + ' ' + str(month),
+                              release_date=datetime(2030, month, 1))
+        response = self.client().get(
+            '/movies?sort=-release_date&title=' + title +
+            '&min_release_date=2030-01-02T00:00:00.000Z'
+            '&max_release_date=2030-07-01T00:00:00.000Z',
+            headers={'Authorization': 'Bearer ' + CASTING_ASSISTANT}
+        )
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [movie['release_date'] for movie in data['movies']],
+            ['2030-07-01T00:00:00.000Z', '2030-04-01T00:00:00.000Z']
+        )
+
+    def test_056_error_get_movies_filter_not_valid(self):
+        """Test error GET /movies when a sort or filter is not valid"""
+        for query in ('sort=-budget', 'min_release_date=soon'):
+            response = self.client().get(
+                '/movies?' + query,
+                headers={'Authorization': 'Bearer ' + CASTING_ASSISTANT}
+            )
+            self.assertEqual(response.status_code, 400)
+
+    def test_057_success_search(self):
+        """Test GET /search finds actor names and movie titles"""
+        word = uuid.uuid4().hex
+        self.create_actor(name='Margot ' + word)
+        self.create_movie(title='Barbie ' + word)
+        response = self.client().get(
+            '/search?q=' + word.upper(),
+            headers={'Authorization': 'Bearer ' + CASTING_ASSISTANT}
+        )
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [actor['name'] for actor in data['actors']], ['Margot ' + word])
+        self.assertEqual(
+            [movie['title'] for movie in data['movies']], ['Barbie ' + word])
+
+    def test_058_error_search_query_missing(self):
+        """Test error GET /search when q is missing"""
+        response = self.client().get(
+            '/search',
+            headers={'Authorization': 'Bearer ' + CASTING_ASSISTANT}
+        )
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(data['message'], 'Bad Request')
+
+    def test_059_success_get_metrics_pool_gauges(self):
+        """Test GET /metrics publishes the connection pool gauges"""
+        self.client().get(
+            '/actors',
+            headers={'Authorization': 'Bearer ' + CASTING_ASSISTANT}
+        )
+        response = self.client().get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'agency_db_pool_connections{state="in_use"}',
+                      response.data)
+        self.assertIn(b'agency_db_pool_waiting', response.data)
+
+    @unittest.skipUnless(
+        TEST_DATABASE_URL.startswith('postgres'),
+        'statement_timeout is a Postgres setting'
+    )
+    def test_060_error_statement_timeout(self):
+        """Test DB_STATEMENT_TIMEOUT cancels long statements"""
+        app = create_app(dict(TEST_CONFIG, DB_STATEMENT_TIMEOUT=50))
+        engine = db.get_engine(app)
+        with self.assertRaises(OperationalError):
+            with engine.connect() as connection:
+                connection.execute(text('SELECT pg_sleep(1)'))
+        engine.dispose()
+
+    def test_061_success_get_performances_server_timing(self):
+        """Test PROFILE reports request phases in Server-Timing"""
+        directory = tempfile.mkdtemp()
+        client = self.create_client(
+            PROFILE=True,
+            PROFILE_SAMPLE_RATE=1,
+            PROFILE_DIR=directory
+        )
+        response = client.get(
+            '/performances',
+            headers={'Authorization': 'Bearer ' + CASTING_ASSISTANT}
+        )
+        self.assertEqual(response.status_code, 200)
+        phases = [metric.split(';')[0] for metric in
+                  response.headers['Server-Timing'].split(', ')]
+        for phase in ('auth', 'sql', 'serialize', 'total'):
+            self.assertIn(phase, phases)
+        self.assertEqual(len(os.listdir(directory)), 1)
+        shutil.rmtree(directory)
+
+    def test_062_success_get_metrics_requests(self):
+        """Test GET /metrics publishes request, SQL and auth metrics"""
+        self.client().get(
+            '/actors',
+            headers={'Authorization': 'Bearer ' + CASTING_ASSISTANT}
+        )
+        self.client().get('/actors')
+        response = self.client().get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(
+            b'agency_http_requests_total{route="/actors",method="GET",'
+            b'status="200"}', response.data)
+        self.assertIn(
+            b'agency_http_request_duration_seconds_bucket{route="/actors",'
+            b'method="GET",le="+Inf"}', response.data)
+        self.assertIn(
+            b'agency_sql_statement_duration_seconds_count{'
+            b'endpoint="get_actors"}', response.data)
+        self.assertIn(
+            b'agency_auth_failures_total{'
+            b'code="authorization_header_missing"}', response.data)
+
+    def test_063_success_warm_up(self):
+        """Test warm_up fetches the signing keys before the first token"""
+        app = create_app(TEST_CONFIG)
+        verifier = app.extensions['auth']
+        self.assertEqual(warm_up(app), 1)
+        payload, permissions = verifier.authenticate(CASTING_ASSISTANT)
+        self.assertIn('get:actors', permissions)
+        self.assertEqual(verifier.jwks.stats()['refreshes'], 1)
+
+    def test_064_error_create_app_without_database_url(self):
+        """Test create_app needs DATABASE_URL, but importing app does not"""
+        with self.assertRaises(RuntimeError):
+            create_app(dict(TEST_CONFIG, DATABASE_URL=None))
+
+    def test_065_success_warm_up_when_unreachable(self):
+        """Test warm_up only logs when Auth0 and the database are down"""
+        directory = tempfile.mkdtemp()
+        app = create_app(dict(
+            TEST_CONFIG,
+            DATABASE_URL='sqlite:///' + os.path.join(directory, 'no', 'db'),
+            JWKS_URL='file://' + os.path.join(directory, 'missing.json')
+        ))
+        with self.assertLogs(app.logger, 'WARNING') as logs:
+            self.assertEqual(warm_up(app, 2), 0)
+        self.assertEqual(len(logs.output), 2)
+        shutil.rmtree(directory)
+
+    def test_066_success_get_actors_by_id_cached_outside_api(self):
+        """Test a write made outside the API invalidates cached responses"""
+        client = self.create_client(CACHE_TYPE='local')
+        actor = self.create_actor()
+        path = '/actors/' + str(actor.id)
+        headers = {'Authorization': 'Bearer ' + CASTING_ASSISTANT}
+        client.get(path, headers=headers)
+        db.session.execute(
+            text('UPDATE actors SET age = 99 WHERE id = :id'),
+            {'id': actor.id})
+        db.session.expire(actor)
+        response = client.get(path, headers=headers)
+        self.assertEqual(response.headers['X-Cache'], 'MISS')
+        self.assertEqual(json.loads(response.data)['actor']['age'], 99)
+
+    def test_067_success_create_app_warns_missing_encoding(self):
+        """Test an unavailable COMPRESS_ENCODINGS entry is logged"""
+        with self.assertLogs('app', 'WARNING') as logs:
+            create_app(dict(TEST_CONFIG, COMPRESS_ENCODINGS=['zstd', 'gzip']))
+        self.assertIn('zstd', logs.output[0])
+
+    @unittest.skipUnless(
+        TEST_DATABASE_URL.startswith('postgres'),
+        'UPDATE ... RETURNING needs Postgres'
+    )
+    def test_068_success_update_by_id_returning(self):
+        """Test update_by_id updates and reads the row in one statement"""
+        actor_id = self.create_actor().id
+        with self.record_statements() as statements:
+            updated = Actor.update_by_id(actor_id, {'age': 31})
+            missing = Actor.update_by_id(actor_id + 1000, {'age': 31})
+            formatted = updated.format()
+        self.assertEqual(len(statements), 2)
+        self.assertTrue(statements[0].startswith('UPDATE actors'))
+        self.assertIn(
+            'RETURNING actors.id, actors.name, actors.gender, actors.age',
+            statements[0])
+        self.assertEqual(formatted, {
+            'id': actor_id,
+            'name': 'Margot Robbie',
+            'gender': 'female',
+            'age': 31
+        })
+        self.assertIsNone(missing)
+
+    def test_069_success_pool_gauges_count_waiting_checkouts(self):
+        """Test only checkouts blocked on an exhausted pool count as
+        waiting"""
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'pool.db')
+        connecting = threading.Event()
+        connect = threading.Event()
+
+        def creator():
+            connecting.set()
+            connect.wait(5)
+            return sqlite3.connect(path, check_same_thread=False)
+
+        engine = create_engine(
+            'sqlite://',
+            creator=creator,
+            poolclass=InstrumentedQueuePool,
+            pool_size=1,
+            max_overflow=0
+        )
+        waiting = POOL_WAITING.value()
+        in_use = POOL_CONNECTIONS.snapshot()[('in_use',)]
+
+        def wait_for_waiting(value):
+            deadline = time.monotonic() + 5
+            while (POOL_WAITING.value() != value
+                   and time.monotonic() < deadline):
+                time.sleep(0.01)
+            return POOL_WAITING.value()
+
+        connections = []
+        first = threading.Thread(
+            target=lambda: connections.append(engine.connect()))
+        first.start()
+        # Opening the pool's first connection is not waiting on the pool
+        connecting.wait(5)
+        self.assertEqual(POOL_WAITING.value(), waiting)
+        connect.set()
+        first.join()
+        self.assertEqual(
+            POOL_CONNECTIONS.snapshot()[('in_use',)], in_use + 1)
+        second = threading.Thread(target=lambda: engine.connect().close())
+        second.start()
+        self.assertEqual(wait_for_waiting(waiting + 1), waiting + 1)
+        connections[0].close()
+        second.join()
+        self.assertEqual(POOL_WAITING.value(), waiting)
+        self.assertEqual(POOL_CONNECTIONS.snapshot()[('in_use',)], in_use)
+        engine.dispose()
+        shutil.rmtree(directory)
+
+    @unittest.skipUnless(
+        TEST_DATABASE_URL.startswith('postgres'),
+        'trigram search needs Postgres with pg_trgm'
+    )
+    def test_070_success_search_nearest_first(self):
+        """Test search ranks by trigram distance, read from the index"""
+        for name in ('Natalie Portman', 'Alicia Vikander', 'Ali Wong', 'Ali'):
+            self.create_actor(name=name)
+        with self.explain_last_select() as plans:
+            actors = Actor.search(Actor.name, 'ALI', 2)
+        self.assertEqual([actor.name for actor in actors], ['Ali', 'Ali Wong'])
+        plan = plans[0]
+        self.assertIn('ix_actors_lower_name_trgm', plan)
+        self.assertIn('Order By: (lower', plan)
+
+    def test_071_success_get_movies_by_id_cache_off(self):
+        """Test GET /movies/:movie_id skips the table versions with the
+        cache off, unless the request carries If-None-Match"""
+        movie = self.create_movie()
+        path = '/movies/' + str(movie.id)
+        headers = {'Authorization': 'Bearer ' + EXECUTIVE_PRODUCER}
+        with self.record_statements() as statements:
+            response = self.client().get(path, headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('ETag', response.headers)
+        self.assertNotIn('X-Cache', response.headers)
+        self.assertFalse(any(
+            'table_versions' in statement for statement in statements))
+        response = self.client().get(
+            path, headers=dict(headers, **{'If-None-Match': 'W/"0"'}))
+        etag = response.headers['ETag']
+        response = self.client().get(
+            path, headers=dict(headers, **{'If-None-Match': etag}))
+        self.assertEqual(response.status_code, 304)
+
+    @unittest.skipUnless(
+        TEST_DATABASE_URL.startswith('postgres'),
+        'text_pattern_ops indexes are Postgres only'
+    )
+    def test_072_success_get_actors_name_filter_indexed(self):
+        """Test the name and title prefix filters are read from an index"""
+        # Enough rows for the planner to prefer it over the primary key
+        self.connection.exec_driver_sql(
+            "INSERT INTO actors (name, gender, age) "
+            "SELECT md5(i::text), 'female', 30 "
+            "FROM generate_series(1, 5000) i")
+        self.connection.exec_driver_sql(
+            "INSERT INTO movies (title, release_date) "
+            "SELECT md5(i::text), now() FROM generate_series(1, 5000) i")
+        self.connection.exec_driver_sql('ANALYZE actors, movies')
+        headers = {'Authorization': 'Bearer ' + EXECUTIVE_PRODUCER}
+        for path, index in (
+                ('/actors?name=Brad', 'ix_actors_lower_name_pattern'),
+                ('/movies?title=Bullet', 'ix_movies_lower_title_pattern')):
+            with self.explain_last_select() as plans:
+                response = self.client().get(path, headers=headers)
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('Index Cond: ((lower', plans[0])
+            self.assertIn(index, plans[0])
+
+    def test_073_success_post_movies_bulk_concurrent_duplicate(self):
+        """Test POST /movies/bulk?atomic=false keeps per item results when
+        a duplicate is inserted after the conflict check"""
+        title = 'Barbie ' + uuid.uuid4().hex
+        inserted = []
+
+        def insert_duplicate(conn, cursor, statement, *args):
+            if statement.startswith('SELECT lower(movies.title)') \
+                    and not inserted:
+                inserted.append(title)
+                conn.execute(Movie.__table__.insert(), {
+                    'title': title, 'release_date': datetime(2099, 7, 21)})
+
+        engine = self.connection.engine
+        event.listen(engine, 'after_cursor_execute', insert_duplicate)
+        try:
+            response = self.client().post(
+                '/movies/bulk?atomic=false',
+                json=[{
+                    'title': title,
+                    'release_date': '2099-07-21T00:00:00.000Z'
+                }, {
+                    'title': 'Oppenheimer ' + uuid.uuid4().hex,
+                    'release_date': '2099-07-21T00:00:00.000Z'
+                }],
+                headers={'Authorization': 'Bearer ' + EXECUTIVE_PRODUCER}
+            )
+        finally:
+            event.remove(engine, 'after_cursor_execute', insert_duplicate)
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(data['success'])
+        self.assertEqual(data['results'][0]['error'], 422)
+        self.assertTrue(data['results'][1]['success'])
+        self.assertEqual(
+            Movie.query.filter(func.lower(Movie.title) == title.lower())
+            .count(), 1)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,208 @@
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+from auth import (
+    AuthError,
+    check_granted,
+    get_permissions,
+    JWKSCache,
+    permission_set,
+    TokenCache
+)
+
+KEY = {'kty': 'RSA', 'kid': 'key-1', 'use': 'sig', 'n': 'abc', 'e': 'AQAB'}
+ROTATED_KEY = dict(KEY, kid='key-2')
+
+
+class JWKSCacheTestCase(unittest.TestCase):
+    """JWKS cache test case"""
+
+    def setUp(self):
+        """Run before each test"""
+        fd, self.path = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        self.write_keys(KEY)
+        self.cache = JWKSCache('file://' + self.path, ttl=60,
+                               refresh_interval=0)
+
+    def tearDown(self):
+        """Run after each test"""
+        os.remove(self.path)
+
+    def write_keys(self, *keys):
+        with open(self.path, 'w') as f:
+            json.dump({'keys': list(keys)}, f)
+
+    def test_fetches_once_within_ttl(self):
+        """Test keys are fetched once and then served from memory"""
+        for _ in range(3):
+            self.assertEqual(self.cache.get_key('key-1'), KEY)
+        stats = self.cache.stats()
+        self.assertEqual(stats['refreshes'], 1)
+        self.assertEqual(stats['hits'], 3)
+        self.assertEqual(stats['misses'], 0)
+
+    def test_warm_fetches_unless_fresh(self):
+        """Test warming fetches the keys ahead of the first lookup"""
+        self.assertEqual(self.cache.warm(), 1)
+        self.assertEqual(self.cache.warm(), 1)
+        self.assertEqual(self.cache.get_key('key-1'), KEY)
+        self.assertEqual(self.cache.stats()['refreshes'], 1)
+
+    def test_refetches_after_ttl(self):
+        """Test keys are fetched again once the TTL has passed"""
+        self.cache.ttl = 0
+        self.cache.get_key('key-1')
+        self.cache.get_key('key-1')
+        self.assertEqual(self.cache.stats()['refreshes'], 2)
+
+    def test_unknown_kid_triggers_refresh(self):
+        """Test an unknown kid refreshes the key set early"""
+        self.cache.get_key('key-1')
+        self.write_keys(KEY, ROTATED_KEY)
+        self.assertEqual(self.cache.get_key('key-2'), ROTATED_KEY)
+        stats = self.cache.stats()
+        self.assertEqual(stats['refreshes'], 2)
+        self.assertEqual(stats['misses'], 1)
+
+    def test_unknown_kid_refresh_is_rate_limited(self):
+        """Test unknown kids refresh at most once per interval"""
+        self.cache.refresh_interval = 60
+        self.cache.get_key('key-1')
+        self.assertIsNone(self.cache.get_key('missing'))
+        self.assertIsNone(self.cache.get_key('missing'))
+        self.assertEqual(self.cache.stats()['refreshes'], 1)
+
+    def test_serves_stale_keys_when_fetch_fails(self):
+        """Test the last good key set is served when a refresh fails"""
+        self.cache.get_key('key-1')
+        self.cache._expires_at = 0
+        os.remove(self.path)
+        self.assertEqual(self.cache.get_key('key-1'), KEY)
+        self.assertEqual(self.cache.stats()['failures'], 1)
+        self.write_keys(KEY)
+
+    def test_error_when_no_keys_available(self):
+        """Test an AuthError is raised when no keys were ever fetched"""
+        cache = JWKSCache('file://' + self.path + '.missing')
+        with self.assertRaises(AuthError) as context:
+            cache.get_key('key-1')
+        self.assertEqual(context.exception.status_code, 503)
+
+    def test_concurrent_refreshes_collapse(self):
+        """Test concurrent lookups share a single fetch"""
+        fetch = self.cache.fetch
+
+        def slow_fetch():
+            time.sleep(0.1)
+            return fetch()
+
+        self.cache.fetch = slow_fetch
+        threads = [
+            threading.Thread(target=self.cache.get_key, args=('key-1',))
+            for _ in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.cache.stats()['refreshes'], 1)
+
+    def test_expired_keys_served_during_refresh(self):
+        """Test lookups past the TTL do not wait for a refresh in flight"""
+        self.cache.get_key('key-1')
+        self.cache._expires_at = 0
+        keys = []
+        lookup = threading.Thread(
+            target=lambda: keys.append(self.cache.get_key('key-1')))
+        with self.cache._lock:
+            # Another thread is fetching the key set
+            lookup.start()
+            lookup.join(1)
+            self.assertEqual(keys, [KEY])
+        lookup.join()
+        self.assertEqual(self.cache.stats()['refreshes'], 1)
+        self.cache.get_key('key-1')
+        self.assertEqual(self.cache.stats()['refreshes'], 2)
+
+
+class TokenCacheTestCase(unittest.TestCase):
+    """Verified token cache test case"""
+
+    def setUp(self):
+        """Run before each test"""
+        self.cache = TokenCache(maxsize=2)
+        self.payload = {'exp': time.time() + 60, 'permissions': []}
+
+    def test_returns_cached_payload(self):
+        """Test a cached token returns its payload"""
+        self.cache.set('token', self.payload, frozenset())
+        self.assertEqual(
+            self.cache.get('token'), (self.payload, frozenset()))
+        self.assertIsNone(self.cache.get('other'))
+        self.assertEqual(self.cache.stats()['hits'], 1)
+        self.assertEqual(self.cache.stats()['misses'], 1)
+
+    def test_evicts_expired_payload(self):
+        """Test a payload is dropped once its exp has passed"""
+        self.cache.set(
+            'token', dict(self.payload, exp=time.time() - 1), frozenset())
+        self.assertIsNone(self.cache.get('token'))
+        self.assertEqual(self.cache.stats()['size'], 0)
+
+    def test_skips_payload_without_exp(self):
+        """Test a payload without exp is never cached"""
+        self.cache.set('token', {'permissions': []}, frozenset())
+        self.assertIsNone(self.cache.get('token'))
+
+    def test_evicts_least_recently_used(self):
+        """Test the least recently used entry is evicted at capacity"""
+        for token in ('a', 'b'):
+            self.cache.set(token, self.payload, frozenset())
+        self.cache.get('a')
+        self.cache.set('c', self.payload, frozenset())
+        self.assertIsNotNone(self.cache.get('a'))
+        self.assertIsNone(self.cache.get('b'))
+        self.assertIsNotNone(self.cache.get('c'))
+
+
+class PermissionsTestCase(unittest.TestCase):
+    """Permission check test case"""
+
+    def test_all_of(self):
+        """Test every required permission must be granted"""
+        granted = frozenset(['get:actors', 'get:movies'])
+        self.assertTrue(check_granted(
+            permission_set(['get:actors', 'get:movies']), granted))
+        with self.assertRaises(AuthError) as context:
+            check_granted(
+                permission_set(['get:actors', 'post:actors']), granted)
+        self.assertEqual(context.exception.status_code, 403)
+
+    def test_any_of(self):
+        """Test one required permission is enough with any_of"""
+        granted = frozenset(['get:actors'])
+        self.assertTrue(check_granted(
+            permission_set(['get:actors', 'post:actors']), granted, True))
+        with self.assertRaises(AuthError):
+            check_granted(permission_set(['post:actors']), granted, True)
+
+    def test_missing_permissions_claim(self):
+        """Test a payload without permissions is rejected"""
+        with self.assertRaises(AuthError) as context:
+            get_permissions({})
+        self.assertEqual(context.exception.status_code, 400)
+
+    def test_role_expansion(self):
+        """Test roles expand to permissions when a roles claim is set"""
+        granted = get_permissions({'roles': ['casting-director']}, 'roles')
+        self.assertIn('get:actors', granted)
+        self.assertIn('post:performances', granted)
+        self.assertNotIn('post:movies', granted)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+import unittest
+from cache import LocalBackend, ResponseCache, SharedBackend
+from flask import Flask, jsonify
+
+
+class FakeRedis:
+    """Local stand-in for the redis.Redis methods SharedBackend uses"""
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value
+
+
+class BackendTestCase(unittest.TestCase):
+    """Cache backend test case"""
+
+    def test_local_evicts_least_recently_used(self):
+        """Test the least recently used entry is evicted at capacity"""
+        backend = LocalBackend(maxsize=2)
+        backend.set('a', b'1', 60)
+        backend.set('b', b'2', 60)
+        backend.get('a')
+        backend.set('c', b'3', 60)
+        self.assertEqual(backend.get('a'), b'1')
+        self.assertIsNone(backend.get('b'))
+        self.assertEqual(backend.get('c'), b'3')
+
+    def test_local_expires_entries(self):
+        """Test an entry is dropped once its ttl has passed"""
+        backend = LocalBackend()
+        backend.set('a', b'1', 0)
+        self.assertIsNone(backend.get('a'))
+
+    def test_shared(self):
+        """Test the shared backend stores values in the client"""
+        backend = SharedBackend(FakeRedis())
+        backend.set('a', b'1', 60)
+        self.assertEqual(backend.get('a'), b'1')
+        self.assertIsNone(backend.get('b'))
+
+
+class ResponseCacheTestCase(unittest.TestCase):
+    """Response cache test case"""
+
+    def setUp(self):
+        """Run before each test"""
+        self.calls = 0
+        self.versions = {}
+        self.cache = ResponseCache(
+            SharedBackend(FakeRedis()),
+            lambda tables: [self.versions.get(table, 0) for table in tables])
+        app = Flask(__name__)
+
+        @app.route('/movies')
+        @self.cache.cached('movies')
+        def get_movies():
+            self.calls += 1
+            return jsonify({'calls': self.calls})
+
+        self.client = app.test_client()
+
+    def test_serves_cached_response(self):
+        """Test a repeated request is served without calling the view"""
+        first = self.client.get('/movies')
+        second = self.client.get('/movies')
+        self.assertEqual(first.headers['X-Cache'], 'MISS')
+        self.assertEqual(second.headers['X-Cache'], 'HIT')
+        self.assertEqual(second.get_json(), {'calls': 1})
+
+    def test_keys_on_escaped_query_arguments(self):
+        """Test an argument holding & and = is keyed apart from the
+        arguments it spells"""
+        keys = []
+        for url in ('/movies?gender=male%26name%3DA',
+                    '/movies?gender=male&name=A'):
+            with Flask(__name__).test_request_context(url):
+                keys.append(self.cache.key(('movies',)))
+        self.assertNotEqual(keys[0], keys[1])
+
+    def test_keys_on_query_arguments(self):
+        """Test requests with different arguments are cached apart"""
+        self.client.get('/movies?limit=1')
+        response = self.client.get('/movies?limit=2')
+        self.assertEqual(response.headers['X-Cache'], 'MISS')
+        response = self.client.get('/movies?limit=1')
+        self.assertEqual(response.headers['X-Cache'], 'HIT')
+
+    def test_keys_on_table_versions(self):
+        """Test a table version bump makes dependent entries unreachable"""
+        self.client.get('/movies')
+        self.versions['actors'] = 1
+        self.assertEqual(self.client.get('/movies').headers['X-Cache'], 'HIT')
+        self.versions['movies'] = 1
+        response = self.client.get('/movies')
+        self.assertEqual(response.headers['X-Cache'], 'MISS')
+        self.assertEqual(response.get_json(), {'calls': 2})
+
+    def test_streamed_requests_bypass_cache(self):
+        """Test streamed requests always reach the view"""
+        self.client.get('/movies')
+        response = self.client.get(
+            '/movies', headers={'Accept': 'application/x-ndjson'})
+        self.assertNotIn('X-Cache', response.headers)
+
+
+if __name__ == '__main__':
+    unittest.main()
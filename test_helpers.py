@@ -0,0 +1,169 @@
+import gzip
+import json
+import logging
+import unittest
+from datetime import datetime
+from flask import Response
+from helpers import (
+    compress_response,
+    decode_cursor,
+    encode_cursor,
+    format_date,
+    get_fields_args,
+    get_json_provider,
+    get_page_args,
+    get_sort_args,
+    parse_date,
+    validate_schema
+)
+from sqlalchemy import Column, DateTime, Integer
+from unittest import mock
+from werkzeug.http import parse_accept_header
+
+
+class ValidateSchemaTestCase(unittest.TestCase):
+    """Schema validation test case"""
+
+    def test_returns_coerced_payload(self):
+        """Test a valid payload is returned with coerced values"""
+        actor = validate_schema(
+            {'name': 'Brad Pitt', 'gender': 'male', 'age': '57'},
+            type='post-actor'
+        )
+        self.assertEqual(actor['age'], 57)
+        movie = validate_schema({
+            'title': 'Bullet Train',
+            'release_date': '2099-09-23T00:00:00.000Z'
+        }, type='post-movie')
+        self.assertEqual(movie['release_date'], datetime(2099, 9, 23))
+
+    def test_returns_none_when_not_valid(self):
+        """Test an invalid payload returns None"""
+        self.assertIsNone(validate_schema(None, type='post-actor'))
+        self.assertIsNone(validate_schema(
+            {'title': 'Bullet Train', 'release_date': '2099-09-23'},
+            type='post-movie'
+        ))
+        self.assertIsNone(validate_schema(
+            {'actor_id': 0, 'movie_id': 1}, type='post-performance'))
+
+    def test_rejects_missing_and_extra_keys(self):
+        """Test a payload missing a required key or with an unknown key
+        is not valid, as with Schema"""
+        self.assertIsNone(validate_schema(
+            {'name': 'Brad Pitt', 'gender': 'male'}, type='post-actor'))
+        self.assertIsNone(validate_schema(
+            {'age': 59, 'height': 180}, type='patch-actor'))
+        self.assertIsNone(validate_schema(
+            [{'actor_id': 1, 'movie_id': 1}], type='post-performance'))
+
+    def test_empty_patch_is_valid(self):
+        """Test an empty patch payload is valid"""
+        self.assertEqual(validate_schema({}, type='patch-actor'), {})
+
+    def test_unknown_type(self):
+        """Test an unknown schema type raises ValueError"""
+        with self.assertRaises(ValueError):
+            validate_schema({}, type='post-director')
+
+
+class CursorTestCase(unittest.TestCase):
+    """Pagination cursor test case"""
+
+    def test_round_trip(self):
+        """Test a cursor decodes to the values it encodes"""
+        self.assertEqual(decode_cursor(encode_cursor([42])), [42])
+
+    def test_not_valid(self):
+        """Test a malformed cursor decodes to None"""
+        self.assertIsNone(decode_cursor('not-a-cursor'))
+        self.assertIsNone(decode_cursor(encode_cursor({'id': 1})))
+
+    def test_page_args_coerce_cursor(self):
+        """Test cursor values are checked against the sort columns"""
+        columns = (Column('release_date', DateTime), Column('id', Integer))
+        cursor = encode_cursor(['2030-01-01T00:00:00.000Z', 7])
+        self.assertEqual(
+            get_page_args({'cursor': cursor}, columns, 10, 100),
+            ([datetime(2030, 1, 1), 7], 10)
+        )
+        for values in ([7], ['soon', 7], ['2030-01-01T00:00:00.000Z', '7']):
+            self.assertIsNone(get_page_args(
+                {'cursor': encode_cursor(values)}, columns, 10, 100))
+
+    def test_sort_args(self):
+        """Test a sort names an allowed column with an optional -"""
+        self.assertEqual(get_sort_args({}, ('id',)), ('id', False))
+        self.assertEqual(
+            get_sort_args({'sort': '-age'}, ('id', 'age')), ('age', True))
+        self.assertIsNone(get_sort_args({'sort': 'salary'}, ('id',)))
+
+
+class FieldsTestCase(unittest.TestCase):
+    """Field projection test case"""
+
+    def test_fields(self):
+        """Test requested fields follow the whitelist order"""
+        allowed = ('id', 'name', 'age')
+        self.assertEqual(get_fields_args({}, allowed), allowed)
+        self.assertEqual(
+            get_fields_args({'fields': 'name, id'}, allowed), ('id', 'name'))
+        self.assertIsNone(get_fields_args({'fields': 'salary'}, allowed))
+
+
+class SerializationTestCase(unittest.TestCase):
+    """JSON serialization test case"""
+
+    def test_format_date_round_trip(self):
+        """Test a formatted date parses back to the same datetime"""
+        date = datetime(2030, 1, 2, 3, 4, 5, 678000)
+        self.assertEqual(format_date(date), '2030-01-02T03:04:05.678Z')
+        self.assertEqual(parse_date(format_date(date)), date)
+
+    def test_providers_agree(self):
+        """Test every JSON provider serializes to the same values"""
+        data = {'id': 1, 'title': 'Barbie', 'at': datetime(2030, 1, 1)}
+        for name in ('json', 'orjson'):
+            self.assertEqual(
+                json.loads(get_json_provider(name)(data)),
+                {'id': 1, 'title': 'Barbie', 'at': '2030-01-01T00:00:00.000Z'}
+            )
+        with self.assertRaises(ValueError):
+            get_json_provider('simplejson')
+
+    def test_orjson_fallback_warns(self):
+        """Test falling back to json when orjson is missing is logged"""
+        logger = logging.getLogger('agency.test')
+        with mock.patch('helpers.orjson', None):
+            with self.assertLogs(logger, 'WARNING'):
+                dumps = get_json_provider('orjson', logger)
+        self.assertEqual(dumps({'id': 1}), b'{"id":1}')
+
+
+class CompressionTestCase(unittest.TestCase):
+    """Response compression test case"""
+
+    def compress(self, data, accept_encoding):
+        response = Response(data, mimetype='application/json')
+        response.set_etag('abc')
+        return compress_response(
+            response, parse_accept_header(accept_encoding), ['gzip'], 10)
+
+    def test_compresses_large_response(self):
+        """Test a large response is gzipped and its ETag made weak"""
+        response = self.compress(b'x' * 100, 'gzip, deflate')
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(response.get_data()), b'x' * 100)
+        self.assertEqual(response.get_etag(), ('abc', True))
+        self.assertIn('Accept-Encoding', response.vary)
+
+    def test_skips_small_or_unaccepted_response(self):
+        """Test small responses and unaccepted encodings are left alone"""
+        for data, accept_encoding in ((b'x', 'gzip'), (b'x' * 100, 'br')):
+            response = self.compress(data, accept_encoding)
+            self.assertNotIn('Content-Encoding', response.headers)
+            self.assertEqual(response.get_data(), data)
+
+
+if __name__ == '__main__':
+    unittest.main()
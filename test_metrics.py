@@ -0,0 +1,159 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from metrics import (
+    Counter,
+    Gauge,
+    Histogram,
+    MultiProcessExporter,
+    render,
+    reset
+)
+
+
+class MetricsTestCase(unittest.TestCase):
+    """Metrics test case"""
+
+    def setUp(self):
+        """Run before each test"""
+        self.registry = []
+
+    def test_render_counter(self):
+        """Test a counter renders in the Prometheus text format"""
+        counter = Counter(
+            'requests_total', 'Requests', ('result',), self.registry)
+        counter.inc(result='hit')
+        counter.inc(2, result='hit')
+        self.assertEqual(
+            render(self.registry),
+            '# HELP requests_total Requests\n'
+            '# TYPE requests_total counter\n'
+            'requests_total{result="hit"} 3\n'
+        )
+
+    def test_gauge(self):
+        """Test a gauge goes up and down"""
+        gauge = Gauge('waiting', 'Waiting', registry=self.registry)
+        gauge.inc()
+        gauge.inc()
+        gauge.dec()
+        self.assertEqual(gauge.value(), 1)
+        gauge.set(5)
+        self.assertEqual(gauge.value(), 5)
+
+    def test_gauge_callback(self):
+        """Test a gauge with a callback renders the callback's values"""
+        Gauge('connections', 'Connections', ('state',), self.registry,
+              callback=lambda: {('idle',): 2})
+        self.assertIn('connections{state="idle"} 2\n', render(self.registry))
+
+    def test_render_histogram(self):
+        """Test a histogram renders cumulative buckets, sum and count"""
+        histogram = Histogram('latency_seconds', 'Latency', ('route',),
+                              self.registry, buckets=(0.1, 1))
+        histogram.observe(0.05, route='/')
+        histogram.observe(0.1, route='/')
+        histogram.observe(2, route='/')
+        lines = render(self.registry).splitlines()[2:]
+        self.assertEqual(lines, [
+            'latency_seconds_bucket{route="/",le="0.1"} 2',
+            'latency_seconds_bucket{route="/",le="1"} 2',
+            'latency_seconds_bucket{route="/",le="+Inf"} 3',
+            'latency_seconds_sum{route="/"} 2.15',
+            'latency_seconds_count{route="/"} 3'
+        ])
+
+
+class MultiProcessExporterTestCase(unittest.TestCase):
+    """Multi-process exporter test case"""
+
+    def setUp(self):
+        """Run before each test"""
+        self.directory = tempfile.mkdtemp()
+        self.registry = []
+        self.counter = Counter('requests_total', 'Requests',
+                               registry=self.registry)
+        self.gauge = Gauge('waiting', 'Waiting', registry=self.registry)
+        self.histogram = Histogram('latency_seconds', 'Latency',
+                                   registry=self.registry, buckets=(1,))
+        self.exporter = MultiProcessExporter(
+            self.directory, registry=self.registry)
+
+    def tearDown(self):
+        """Executed after each test"""
+        shutil.rmtree(self.directory)
+
+    def write_process(self, pid, data):
+        """Write the snapshot file of another process"""
+        with open(os.path.join(self.directory, f'{pid}.json'), 'w') as f:
+            f.write(data)
+
+    def test_merge_processes(self):
+        """Test snapshots of several processes are merged when rendered"""
+        self.write_process(os.getppid(), '''{
+            "requests_total": [[[], 2]],
+            "waiting": [[[], 1]],
+            "latency_seconds": [[[], [1, 0, 0.5]]]
+        }''')
+        self.counter.inc()
+        self.gauge.inc()
+        self.histogram.observe(2)
+        output = self.exporter.render()
+        self.assertIn('requests_total 3\n', output)
+        self.assertIn('waiting 2\n', output)
+        self.assertIn('latency_seconds_bucket{le="1"} 1\n', output)
+        self.assertIn('latency_seconds_count 2\n', output)
+        self.assertIn('latency_seconds_sum 2.5\n', output)
+
+    def test_exited_process(self):
+        """Test exited processes keep their counters but not gauges"""
+        # PIDs are capped well below this on Linux and macOS
+        self.write_process(2 ** 30, '''{
+            "requests_total": [[[], 2]],
+            "waiting": [[[], 1]]
+        }''')
+        output = self.exporter.render()
+        self.assertIn('requests_total 2\n', output)
+        self.assertNotIn('waiting 1\n', output)
+        self.assertFalse(os.path.exists(
+            os.path.join(self.directory, f'{2 ** 30}.json')))
+        self.assertIn('requests_total 2\n', self.exporter.render())
+
+    def test_reused_pid(self):
+        """Test a process reusing the PID of an exited one keeps its
+        counters"""
+        self.write_process(os.getpid(), '{"requests_total": [[[], 2]]}')
+        self.counter.inc()
+        self.assertIn('requests_total 3\n', self.exporter.render())
+        self.counter.inc()
+        self.assertIn('requests_total 4\n', self.exporter.render())
+
+    def test_start(self):
+        """Test a started process writes its snapshot without rendering"""
+        self.exporter.flush_interval = 0.01
+        self.counter.inc()
+        self.exporter.start()
+        path = os.path.join(self.directory, f'{os.getpid()}.json')
+        deadline = time.monotonic() + 5
+        while not os.path.exists(path) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.exporter.flush_interval = 60
+        with open(path) as f:
+            self.assertEqual(json.load(f)['requests_total'], [[[], 1]])
+
+    def test_reset(self):
+        """Test a forked worker drops the values inherited on fork"""
+        self.counter.inc()
+        self.histogram.observe(2)
+        reset(self.registry)
+        self.counter.inc()
+        output = self.exporter.render()
+        self.assertIn('requests_total 1\n', output)
+        self.assertNotIn('latency_seconds_count', output)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,37 @@
+import unittest
+from flask import Flask, g
+from profiling import format_server_timing, timed
+
+
+class ProfilingTestCase(unittest.TestCase):
+    """Request profiling test case"""
+
+    def test_timed_without_request(self):
+        """Test timed is a no-op outside an instrumented request"""
+        with timed('validate'):
+            pass
+        with Flask(__name__).app_context():
+            with timed('validate'):
+                pass
+            self.assertIsNone(g.get('profile_timings'))
+
+    def test_timed_adds_up(self):
+        """Test repeated phases add up in the request timings"""
+        with Flask(__name__).app_context():
+            g.profile_timings = {}
+            for _ in range(2):
+                with timed('validate'):
+                    pass
+            self.assertEqual(list(g.profile_timings), ['validate'])
+            self.assertGreater(g.profile_timings['validate'], 0)
+
+    def test_format_server_timing(self):
+        """Test timings format as a Server-Timing header value"""
+        self.assertEqual(
+            format_server_timing({'auth': 0.0012, 'sql': 0.003}, 2),
+            'auth;dur=1.20, sql;dur=3.00;desc="2 statements"'
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()